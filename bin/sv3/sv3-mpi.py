@@ -133,8 +133,11 @@ def main():
         groups = comm.bcast(groups, root=0)
         suffix = comm.bcast(suffix, root=0)
 
+    # Flatten the per-rank lists, since the galaxies are handed out to the
+    # ranks on demand, largest first (see legacyhalos.mpi.work_queue).
+    todo = np.hstack(groups).astype(int)
+    ntodo = len(todo)
     if rank == 0:
-        ntodo = len(np.hstack(groups))
         print(
             "{} left to do: {} / {} divided across {} rank(s).".format(suffix.upper(), ntodo, len(sample), size),
             flush=True,
@@ -144,10 +147,10 @@ def main():
     if comm is not None:
         comm.barrier()
 
-    if len(groups[rank]) == 0:
-        # This MPI rank has no more work to do, so early exit.
+    if ntodo == 0:
+        # There is no more work to do, so early exit.
         print(
-            "{} for all {} galaxies on rank {} are complete!".format(suffix.upper(), len(sample), rank),
+            "{} for all {} galaxies are complete!".format(suffix.upper(), len(sample)),
             flush=True,
         )
 
@@ -171,41 +174,52 @@ def main():
             comm.barrier()
         return
 
-    print("Rank {}: {} galaxies left to do.".format(rank, len(groups[rank])), flush=True)
-
-    if rank == 0 and args.count and args.debug:
-        if len(fail[rank]) > 0:
-            print(
-                "{} failures: {} / {}".format(suffix.upper(), len(fail[rank]), len(sample)),
-                flush=True,
-            )
-            galaxy, galaxydir = get_galaxy_galaxydir(sample[fail[rank]])
-            for ii, dd, diam in zip(fail[rank], np.atleast_1d(galaxydir), sample[fail[rank]][DIAMCOLUMN]):
-                print("  {} {} (r={:.3f} arcsec)".format(ii, dd, diam))
-
-        todo = np.hstack(groups)
-        if len(todo) > 0:
-            print(
-                "{} todo: {} / {}".format(suffix.upper(), len(todo), len(sample)),
-                flush=True,
-            )
-            galaxy, galaxydir = get_galaxy_galaxydir(sample[todo])
-            for ii, dd, diam in zip(todo, np.atleast_1d(galaxydir), sample[todo][DIAMCOLUMN]):
-                print("  {} {} (r={:.3f} arcsec)".format(ii, dd, diam))
+    # Return on every rank, since setting up the work queue below is collective.
+    if args.count:
+        if rank == 0 and args.debug:
+            if len(fail[rank]) > 0:
+                print(
+                    "{} failures: {} / {}".format(suffix.upper(), len(fail[rank]), len(sample)),
+                    flush=True,
+                )
+                galaxy, galaxydir = get_galaxy_galaxydir(sample[fail[rank]])
+                for ii, dd, diam in zip(fail[rank], np.atleast_1d(galaxydir), sample[fail[rank]][DIAMCOLUMN]):
+                    print("  {} {} (r={:.3f} arcsec)".format(ii, dd, diam))
+
+            todo = np.hstack(groups)
+            if len(todo) > 0:
+                print(
+                    "{} todo: {} / {}".format(suffix.upper(), len(todo), len(sample)),
+                    flush=True,
+                )
+                galaxy, galaxydir = get_galaxy_galaxydir(sample[todo])
+                for ii, dd, diam in zip(todo, np.atleast_1d(galaxydir), sample[todo][DIAMCOLUMN]):
+                    print("  {} {} (r={:.3f} arcsec)".format(ii, dd, diam))
         if comm is not None:
             comm.barrier()
         return
 
     # Loop on the remaining objects.
     print(
-        "Starting {} {} on rank {} with {} cores on {}".format(
-            len(groups[rank]), suffix.upper(), rank, args.nproc, time.asctime()
-        ),
+        "Starting {} on rank {} with {} cores on {}".format(suffix.upper(), rank, args.nproc, time.asctime()),
         flush=True,
     )
 
+    # Reuse a single pool of workers for all the galaxies on this rank.
+    pool = None
+    if args.ellipse:
+        import multiprocessing
+        pool = multiprocessing.Pool(args.nproc)
+
+    # Optionally log the time and memory spent in each stage of the pipeline.
+    if args.profile:
+        import legacyhalos.profiler
+        legacyhalos.profiler.enable_profiler(os.path.join(args.profile, 'profile-rank{:04d}.fits'.format(rank)), rank=rank)
+
+    from legacyhalos.mpi import work_queue
+
     tall = time.time()
-    for count, ii in enumerate(groups[rank]):
+    for count, ii in enumerate(work_queue(todo, comm=comm, weight=sample[DIAMCOLUMN][todo])):
         onegal = sample[ii]
         galaxy, galaxydir = get_galaxy_galaxydir(onegal)
 
@@ -213,7 +227,7 @@ def main():
             os.makedirs(galaxydir, exist_ok=True)
 
         print(
-            "Rank {:03d} ({} / {}): {} (index {})".format(rank, count + 1, len(groups[rank]), galaxydir, ii),
+            "Rank {:03d} ({} / {}): {} (index {})".format(rank, count + 1, ntodo, galaxydir, ii),
             flush=True,
         )
 
@@ -296,6 +310,10 @@ def main():
                     refband="r",
                     pixscale=args.pixscale,
                     nproc=args.nproc,
+                    pool=pool,
+                    sharedmem=args.sharedmem,
+                    fastprofile=args.fastprofile,
+                    float32=args.float32,
                     verbose=args.verbose,
                     debug=args.debug,
                     sky_tests=args.sky_tests,
@@ -337,6 +355,10 @@ def main():
                 read_multiband=read_multiband,
             )
 
+    if pool is not None:
+        pool.close()
+        pool.join()
+
     # Wait for all ranks to finish.
     print(f"Rank {rank} waiting at barrier.", flush=True)
     if comm is not None:
@@ -19,6 +19,7 @@ from scipy.optimize import curve_fit
 
 from legacyhalos.desiutil import brickname as get_brickname
 import legacyhalos.io
+from legacyhalos.profiler import profiled
 
 ZCOLUMN = "Z"
 RACOLUMN = "GROUP_RA"
@@ -241,6 +242,44 @@ def mpi_args():
     parser.add_argument("--debug", action="store_true", help="Log to STDOUT and build debugging plots.")
     parser.add_argument("--verbose", action="store_true", help="Enable verbose output.")
     parser.add_argument("--clobber", action="store_true", help="Overwrite existing files.")
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        help="Write per-stage timing and memory profiling logs (one per rank) to this directory.",
+    )
+    parser.add_argument(
+        "--sharedmem",
+        action="store_true",
+        help="Pass the images to the isophote-fitting pool via shared memory.",
+    )
+    parser.add_argument(
+        "--fastprofile",
+        action="store_true",
+        help="Extract the surface-brightness profiles with the vectorized fixed-geometry sampler.",
+    )
+    parser.add_argument(
+        "--float32",
+        action="store_true",
+        help="Do the elliptical aperture photometry in single precision.",
+    )
+    parser.add_argument(
+        "--statusdir",
+        type=str,
+        default=None,
+        help="Record and look up the status of each galaxy in this directory (see legacyhalos.status).",
+    )
+    parser.add_argument(
+        "--scandirs",
+        action="store_true",
+        help="Find the missing files by listing each directory once rather than checking each file.",
+    )
+    parser.add_argument(
+        "--costmodel",
+        type=str,
+        default=None,
+        help="Hand out the galaxies in order of their cost predicted by this model (see SGA-costmodel).",
+    )
 
     parser.add_argument("--remake-cogqa", action="store_true", help="Remake the COG plots.")
     parser.add_argument("--build-SGA", action="store_true", help="Build the SGA reference catalog.")
@@ -252,9 +291,10 @@ def mpi_args():
 def missing_files(args, sample, size=1, clobber_overwrite=None):
     from glob import glob
     import multiprocessing
-    from legacyhalos.io import _missing_files_one
+    from legacyhalos.io import _missing_files_one, scan_missing_files
+    from legacyhalos.status import status_enabled, status_stage, lookup_status, record_status
 
-    dependson = None
+    dependson, dependsondir = None, None
     if args.htmlplots is False and args.htmlindex is False:
         if args.verbose:
             t0 = time.time()
@@ -334,6 +374,10 @@ def missing_files(args, sample, size=1, clobber_overwrite=None):
     if clobber_overwrite is not None:
         clobber = clobber_overwrite
 
+    # the stage we depend on writes its files to the same directory
+    if dependsondir is None:
+        dependsondir = galaxydir
+
     if type(sample) is astropy.table.row.Row:
         ngal = 1
     else:
@@ -387,11 +431,33 @@ def missing_files(args, sample, size=1, clobber_overwrite=None):
     if args.verbose:
         t0 = time.time()
         print("Finding missing files...", end="")
-    if args.nproc > 1:
+
+    # Look up the galaxies which are done in the status database first (if
+    # enabled), and only check the files of the other ones, including the
+    # ones which failed (so deleting an .isfail file reruns a galaxy).
+    todo = np.zeros(len(missargs), "U4")
+    if status_enabled() and not use_glob:
+        todo[:] = lookup_status(galaxy, filesuffix, dependson=dependson, clobber=clobber)
+    icheck = np.where(todo == "")[0]
+    checkargs = [missargs[ii] for ii in icheck]
+
+    if args.scandirs and len(checkargs) > 0:
+        todo[icheck] = scan_missing_files(checkargs, nthreads=max(args.nproc, 8))
+    elif args.nproc > 1 and len(checkargs) > 0:
         with multiprocessing.Pool(args.nproc) as P:
-            todo = np.array(P.map(_missing_files_one, missargs))
+            todo[icheck] = P.map(_missing_files_one, checkargs)
     else:
-        todo = np.array([_missing_files_one(_missargs) for _missargs in missargs])
+        todo[icheck] = [_missing_files_one(_missargs) for _missargs in checkargs]
+
+    # ...and add the galaxies which are done on disk to the database, so they
+    # do not have to be checked again next time.
+    if status_enabled() and not use_glob and status_stage(filesuffix) is not None:
+        these = todo[icheck] == "done"
+        if np.any(these):
+            checkgal = np.atleast_1d(galaxy)[icheck][these]
+            record_status(checkgal, status_stage(filesuffix), "done", runtime=-1.0)
+            if status_stage(dependson) is not None:
+                record_status(checkgal, status_stage(dependson), "done", runtime=-1.0)
 
     # hack
     # todo = np.repeat('todo', len(galaxy))
@@ -438,6 +504,30 @@ def get_raslice(ra):
     return "{:06d}".format(int(ra * 1000))[:3]
 
 
+def get_radius_mosaic(diam):
+    """Radius of the custom mosaic [arcsec] given the (group) diameter [arcmin]."""
+    diam = np.asarray(diam, "f8")
+    factor = np.where(diam > 30, 0.7, np.where((diam > 14) * (diam < 30), 1.0, 1.5))  # NGC0598=M33 is 61 arcmin!
+    return diam * 60 * factor
+
+
+def get_cost_features(sample, pixscale=0.262, bands=["g", "r", "z"], nsource=None):
+    """Features of the runtime cost model (see costmodel.cost_features).
+
+    nsource - optional number of Tractor sources of each galaxy
+
+    """
+    from legacyhalos.coadds import _mosaic_width
+    from legacyhalos.costmodel import cost_features
+
+    width = _mosaic_width(get_radius_mosaic(sample[DIAMCOLUMN]), pixscale)
+    if "GROUP_MULT" in sample.colnames:
+        mult = sample["GROUP_MULT"]
+    else:
+        mult = None
+    return cost_features(width, len(bands), nsource=nsource, mult=mult)
+
+
 def get_galaxy_galaxydir(cat, datadir=None, htmldir=None, html=False, candidates=False):
     """Retrieve the galaxy name and the (nested) directory."""
     if datadir is None:
@@ -1024,124 +1114,239 @@ def _init_ellipse_SGA(clobber=False):
     return outfile, dropfile, refcat
 
 
+def _scan_ellipse_SGA(parts, columns):
+    """First pass through a list of ellipse catalogs (see _write_ellipse_SGA),
+    which may be astropy Tables or FITS files, without holding more than one
+    (file) catalog in memory at a time.
+
+    Returns the (promoted) data type of the stacked catalog, the number of rows
+    in each catalog, and the stacked values of the requested columns.
+
+    """
+    import fitsio
+
+    names, dtypes, nrows, values = [], {}, [], {col: [] for col in columns}
+    for part in parts:
+        if isinstance(part, str):
+            with fitsio.FITS(part) as ff:
+                dtype, nrow = ff[1].get_rec_dtype()[0], ff[1].get_nrows()
+                if len(columns) > 0:
+                    data = ff[1].read(columns=columns)
+        else:
+            dtype, nrow, data = part.dtype, len(part), part
+        for name in dtype.names:
+            if name in dtypes:
+                dtypes[name] = np.dtype((np.promote_types(dtypes[name].base, dtype[name].base), dtype[name].shape))
+            else:
+                names.append(name)
+                dtypes[name] = dtype[name]
+        nrows.append(nrow)
+        for col in columns:
+            values[col].append(np.asarray(data[col]))
+
+    dtype = np.dtype([(name, dtypes[name]) for name in names])
+    values = {col: np.concatenate(values[col]).astype(dtype[col]) for col in columns}
+
+    return dtype, np.array(nrows, int), values
+
+
+def _fill_ellipse_SGA(out, parts, nrows, dest, keep=None):
+    """Second pass through a list of ellipse catalogs (see _scan_ellipse_SGA):
+    copy the rows of each catalog (optionally, only the rows where keep=True)
+    into rows dest of the preallocated output array out.
+
+    """
+    import fitsio
+
+    if keep is None:
+        keep = np.ones(np.sum(nrows), bool)
+
+    irow, iout = 0, 0
+    for part, nrow in zip(parts, nrows):
+        thiskeep = keep[irow : irow + nrow]
+        nkeep = np.count_nonzero(thiskeep)
+        if nkeep > 0:
+            data = fitsio.read(part, ext=1) if isinstance(part, str) else part
+            rows = dest[iout : iout + nkeep]
+            for col in data.dtype.names:
+                if col in out.dtype.names:
+                    out[col][rows] = np.asarray(data[col])[thiskeep]
+            del data
+        irow += nrow
+        iout += nkeep
+
+
+def _init_ellipse_SGA_array(nrow, dtype):
+    """Preallocate the output catalog, with -1 in every (signed) numerical column
+    and zero (or False, or blank) in every other column.
+
+    """
+    out = np.zeros(nrow, dtype=dtype)
+    for col in dtype.names:
+        if dtype[col].base.kind in ("i", "f"):
+            out[col] = -1
+    return out
+
+
+def _write_fits_chunked(outfile, data, header=None, nchunk=100000):
+    """Write a structured array to a FITS binary table in chunks of nchunk rows, so
+    fitsio only has to (byte-swap and) buffer one chunk at a time. The table
+    is written to a temporary file which is renamed at the end, so a
+    partially written catalog never looks complete.
+
+    """
+    import fitsio
+
+    tmpfile = outfile + ".tmp"
+    with fitsio.FITS(tmpfile, "rw", clobber=True) as ff:
+        ff.write(data[:nchunk], header=header)
+        for irow in range(nchunk, len(data), nchunk):
+            ff[-1].append(data[irow : irow + nchunk])
+    os.rename(tmpfile, outfile)
+
+
 def _write_ellipse_SGA(cat, dropcat, outfile, dropfile, refcat, exclude_full_sga=False, writekd=True):
-    import shutil
+    """Merge the ellipse-fitting results with the parent SGA catalog and write out
+    the final catalog.
+
+    cat, dropcat - lists of the per-galaxy catalogs of frozen and dropped
+      galaxies (from build_ellipse_SGA_one), either as astropy Tables or as
+      the names of FITS files (e.g., the per-chunk catalogs written by
+      SGA-mpi --build-SGA), which are only read one at a time
+
+    The output catalog is preallocated and filled in place, directly in its
+    final (sorted) order, and then written out in chunks, so the memory
+    footprint is roughly the size of the output catalog plus the parent SGA
+    catalog and the largest input catalog.
+
+    """
     import fitsio
-    from astropy.table import Table, vstack, join
     from legacyhalos.SGA import SGA_version
 
-    # from contextlib import redirect_stdout, redirect_stderr
-
     version = SGA_version()
 
     if len(cat) == 0:
         print("Something went wrong and no galaxies were fitted.")
         return
-    cat = vstack(cat)
 
     if len(dropcat) > 0:
-        dropcat = vstack(dropcat)
+        dropdtype, dropnrows, _ = _scan_ellipse_SGA(dropcat, [])
+        _dropcat = np.zeros(np.sum(dropnrows), dtype=dropdtype)
+        _fill_ellipse_SGA(_dropcat, dropcat, dropnrows, np.arange(len(_dropcat)))
+        dropcat = _dropcat
         print("Writing {} galaxies to {}".format(len(dropcat), dropfile))
-        dropcat.write(dropfile, overwrite=True)
+        _write_fits_chunked(dropfile, dropcat)
 
-    print("Gathered {} pre-burned and frozen galaxies.".format(len(cat)))
-    print("  Frozen (all): {}".format(np.sum(cat["FREEZE"])))
-    print("  Frozen (SGA): {}".format(np.sum(cat["FREEZE"] * (cat["REF_CAT"] == refcat))))
-    print("  Pre-burned: {}".format(np.sum(cat["PREBURNED"])))
+    catdtype, catnrows, catcols = _scan_ellipse_SGA(cat, ["FREEZE", "REF_CAT", "PREBURNED", "SGA_ID"])
+    freeze = catcols["FREEZE"]
+    isrefcat = np.char.strip(catcols["REF_CAT"]) == np.asarray(refcat).astype(catcols["REF_CAT"].dtype)
+    print("Gathered {} pre-burned and frozen galaxies.".format(len(freeze)))
+    print("  Frozen (all): {}".format(np.sum(freeze)))
+    print("  Frozen (SGA): {}".format(np.sum(freeze * isrefcat)))
+    print("  Pre-burned: {}".format(np.sum(catcols["PREBURNED"])))
 
     # We only have frozen galaxies here, but whatever--
-    ifreeze = np.where(cat["FREEZE"])[0]
-    isga = np.where(cat["FREEZE"] * (cat["REF_CAT"] == refcat))[0]
+    catsgaid = catcols["SGA_ID"][freeze]
+    print("Keeping {} frozen galaxies, of which {} are SGA.".format(np.sum(freeze), np.sum(freeze * isrefcat)))
 
-    cat = cat[ifreeze]
-    print("Keeping {} frozen galaxies, of which {} are SGA.".format(len(ifreeze), len(isga)))
-
-    # Read the full parent SGA catalog and add all the Tractor columns.
+    # Read the full parent SGA catalog (we only need the header if we are not
+    # going to merge it with the ellipse-fitting results).
     sgafile = os.getenv("LARGEGALAXIES_CAT")
-    sga, hdr = fitsio.read(sgafile, header=True)
-    sga = Table(sga)
-    print("Read {} galaxies from {}".format(len(sga), sgafile))
-
-    # Remove the already-burned SGA galaxies so we don't double-count them--
-    isga2 = np.where(cat["FREEZE"] * (cat["REF_CAT"] == refcat))[0]
-    rem = np.where(np.isin(sga["SGA_ID"], cat["SGA_ID"][isga2]))[0]
-    print("Removing {} pre-burned SGA galaxies from the parent catalog, so we do not double-count them.".format(len(rem)))
-    sga = sga[np.delete(np.arange(len(sga)), rem)]  # remove duplicates
-
-    # Update the reference diameter for objects that were not pre-burned--
-    print("Updating the reference diameter from Hyperleda.")
-    sga["DIAM"] *= 1.25
-
-    # Next, remove all galaxies from the 'dropcat' catalog *except* those with
-    # DROPBITS[notfit] | DROPBITS[nogrz]. Every other galaxy is spurious (or not
-    # large) in some fashion. Update: all 'dropped' galaxies should be kept!
-    print("Found {} SGA galaxies in the dropcat catalog.".format(len(dropcat)))
-    if len(dropcat) > 0:
-        if False:
-            ignore = np.logical_or(
-                dropcat["DROPBIT"] & DROPBITS["notfit"] != 0,
-                dropcat["DROPBIT"] & DROPBITS["masked"] != 0,
-            )
-            ignore = np.logical_or(ignore, dropcat["DROPBIT"] & DROPBITS["nogrz"] != 0)
-            ignore = np.where(ignore)[0]
-        else:
-            ignore = np.arange(len(dropcat))
-        if len(ignore) > 0:
-            print("Not removing {} dropped SGA galaxies.".format(len(ignore)))
-            ignore_dropcat = dropcat[np.delete(np.arange(len(dropcat)), ignore)]  # remove duplicates
-        if len(ignore_dropcat) > 0:
-            print("Removing {} SGA dropped galaxies.".format(len(ignore_dropcat)))
-            rem = np.where(np.isin(sga["SGA_ID"], ignore_dropcat["SGA_ID"]))[0]
-            assert len(rem) == len(ignore_dropcat)
-            sga = sga[np.delete(np.arange(len(sga)), rem)]
-
-    sga.rename_column("RA", "RA_LEDA")
-    sga.rename_column("DEC", "DEC_LEDA")
-    for col in cat.colnames:
-        if col in sga.colnames:
-            # print('  Skipping existing column {}'.format(col))
-            pass
-        else:
-            if cat[col].ndim > 1:
-                # assume no multidimensional strings or Boolean
-                sga[col] = np.zeros((len(sga), cat[col].shape[1]), dtype=cat[col].dtype) - 1
-            else:
-                typ = cat[col].dtype.type
-                if typ is np.str_ or typ is np.str or typ is np.bool_ or typ is np.bool:
-                    sga[col] = np.zeros(len(sga), dtype=cat[col].dtype)
-                else:
-                    sga[col] = np.zeros(len(sga), dtype=cat[col].dtype) - 1
-    sga["RA"][:] = sga["RA_LEDA"]
-    sga["DEC"][:] = sga["DEC_LEDA"]
-    sga["DROPBIT"][:] = DROPBITS["nogrz"]  # outside the footprint
-    sga["ELLIPSEBIT"][:] = ELLIPSEBITS["notfit"]  # not fit
-    if len(dropcat) > 0:
-        these = np.where(np.isin(sga["SGA_ID"], dropcat["SGA_ID"]))[0]
-        assert len(these) == len(dropcat)
-        sga["DROPBIT"][these] = dropcat["DROPBIT"]
-        sga["ELLIPSEBIT"][these] = ELLIPSEBITS["rejected"]
-
-    # Stack!
     if exclude_full_sga:
-        # print('Temporarily leaving off the original SGA!')
-        out = cat
+        hdr = fitsio.read_header(sgafile, ext=1)
+        sga = None
+    else:
+        sga, hdr = fitsio.read(sgafile, header=True)
+        print("Read {} galaxies from {}".format(len(sga), sgafile))
+
+        # Remove the already-burned SGA galaxies so we don't double-count them--
+        rem = np.isin(sga["SGA_ID"], catcols["SGA_ID"][freeze * isrefcat])
+        print("Removing {} pre-burned SGA galaxies from the parent catalog, so we do not double-count them.".format(np.sum(rem)))
+        sga = sga[~rem]  # remove duplicates
+
+        # Update the reference diameter for objects that were not pre-burned--
+        print("Updating the reference diameter from Hyperleda.")
+        sga["DIAM"] *= 1.25
+
+        # Next, remove all galaxies from the 'dropcat' catalog *except* those with
+        # DROPBITS[notfit] | DROPBITS[nogrz]. Every other galaxy is spurious (or not
+        # large) in some fashion. Update: all 'dropped' galaxies should be kept!
+        print("Found {} SGA galaxies in the dropcat catalog.".format(len(dropcat)))
+        if len(dropcat) > 0:
+            if False:
+                ignore = np.logical_or(
+                    dropcat["DROPBIT"] & DROPBITS["notfit"] != 0,
+                    dropcat["DROPBIT"] & DROPBITS["masked"] != 0,
+                )
+                ignore = np.logical_or(ignore, dropcat["DROPBIT"] & DROPBITS["nogrz"] != 0)
+                ignore = np.where(ignore)[0]
+            else:
+                ignore = np.arange(len(dropcat))
+            if len(ignore) > 0:
+                print("Not removing {} dropped SGA galaxies.".format(len(ignore)))
+                ignore_dropcat = dropcat[np.delete(np.arange(len(dropcat)), ignore)]  # remove duplicates
+            if len(ignore_dropcat) > 0:
+                print("Removing {} SGA dropped galaxies.".format(len(ignore_dropcat)))
+                rem = np.isin(sga["SGA_ID"], ignore_dropcat["SGA_ID"])
+                assert np.sum(rem) == len(ignore_dropcat)
+                sga = sga[~rem]
+
+    # Build the data type of the output catalog: the columns of the parent SGA
+    # catalog (with RA, DEC renamed to RA_LEDA, DEC_LEDA) followed by the new
+    # columns from the ellipse-fitting results. Leo I had unWISE time-resolved
+    # photometry, which we don't need or want, so remove it here (annoying
+    # hack). Also remove the FITBITS column, since that was added late as well.
+    sgarename = {"RA": "RA_LEDA", "DEC": "DEC_LEDA"}
+    outdtype = {}
+    if sga is not None:
+        for col in sga.dtype.names:
+            outcol = sgarename.get(col, col)
+            if outcol in catdtype.names:
+                base = np.promote_types(sga.dtype[col].base, catdtype[outcol].base)
+                outdtype[outcol] = np.dtype((base, catdtype[outcol].shape))
+            else:
+                outdtype[outcol] = sga.dtype[col]
+    for col in catdtype.names:
+        if col not in outdtype:
+            outdtype[col] = catdtype[col]
+    outdtype = np.dtype([(col, dt) for col, dt in outdtype.items() if not (col == "FITBITS" or "NEA" in col or "LC_" in col)])
+
+    # Sort by SGA_ID (with the non-SGA sources at the end) and work out where
+    # each parent and ellipse-fitting row lands in the output catalog.
+    nsga = 0 if sga is None else len(sga)
+    if sga is not None:
+        sgaid = np.concatenate((sga["SGA_ID"].astype(outdtype["SGA_ID"]), catsgaid.astype(outdtype["SGA_ID"])))
     else:
-        out = vstack((sga, cat))
-    del sga, cat
-    out = out[np.argsort(out["SGA_ID"])]
-    out = vstack((out[out["SGA_ID"] != -1], out[out["SGA_ID"] == -1]))
-
-    # Annoying hack. Leo I had unWISE time-resolved photometry, which we don't
-    # need or want; remove it here. Also remove the FITBITS column, since that
-    # was added late as well.
-    for col in out.colnames:
-        if col == "FITBITS" or "NEA" in col or "LC_" in col:
-            out.remove_column(col)
+        sgaid = catsgaid
+    srt = np.argsort(sgaid)
+    srt = np.concatenate((srt[sgaid[srt] != -1], srt[sgaid[srt] == -1]))
+    dest = np.empty_like(srt)
+    dest[srt] = np.arange(len(srt))
+    del sgaid, srt
+
+    out = _init_ellipse_SGA_array(len(dest), outdtype)
+
+    if sga is not None:
+        sgadest = dest[:nsga]
+        for col in sga.dtype.names:
+            out[sgarename.get(col, col)][sgadest] = sga[col]
+        out["RA"][sgadest] = sga["RA"]
+        out["DEC"][sgadest] = sga["DEC"]
+        out["DROPBIT"][sgadest] = DROPBITS["nogrz"]  # outside the footprint
+        out["ELLIPSEBIT"][sgadest] = ELLIPSEBITS["notfit"]  # not fit
+        if len(dropcat) > 0:
+            these = np.where(np.isin(sga["SGA_ID"], dropcat["SGA_ID"]))[0]
+            assert len(these) == len(dropcat)
+            out["DROPBIT"][sgadest[these]] = dropcat["DROPBIT"]
+            out["ELLIPSEBIT"][sgadest[these]] = ELLIPSEBITS["rejected"]
+        del sga
+
+    _fill_ellipse_SGA(out, cat, catnrows, dest[nsga:], keep=freeze)
 
     print("Writing {} galaxies to {}".format(len(out), outfile))
     hdrversion = "L{}-ELLIPSE".format(version[1:2])  # fragile!
     hdr["SGAVER"] = hdrversion
-    fitsio.write(outfile, out.as_array(), header=hdr, clobber=True)
+    _write_fits_chunked(outfile, out, header=hdr)
 
     # Write the KD-tree version
     if writekd:
@@ -1150,9 +1355,10 @@ def _write_ellipse_SGA(cat, dropcat, outfile, dropfile, refcat, exclude_full_sga
         print(cmd)
         _ = os.system(cmd)
 
-        cmd = "modhead {} SGAVER {}".format(kdoutfile, hdrversion)
-        print(cmd)
-        _ = os.system(cmd)
+        # equivalent to modhead kdoutfile SGAVER hdrversion
+        print("Setting SGAVER={} in {}".format(hdrversion, kdoutfile))
+        with fitsio.FITS(kdoutfile, "rw") as F:
+            F[0].write_key("SGAVER", hdrversion)
 
     # fix_permissions = True
     # if fix_permissions:
@@ -2043,20 +2249,25 @@ def build_ellipse_SGA_one(onegal, fullsample, refcat="L3", seed=1, verbose=False
     return tractor, dropcat
 
 
+@profiled("build_multiband_mask")
 def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0, verbose=False):
     """Wrapper to prepare the data for the SGA / large-galaxy project."""
     import numpy.ma as ma
     from legacyhalos.mge import find_galaxy
-    from legacyhalos.misc import srcs2image, ellipse_mask
+    from legacyhalos.misc import cached_srcs2image, ellipse_mask, ellipse_mask_inplace
 
     bands, refband = data["bands"], data["refband"]
     residual_mask = data["residual_mask"]
 
+    # Per-source model stamps, rendered once per bandpass and reused for every
+    # central (see misc.cached_srcs2image).
+    modelcache = {}
+
     nbox = 5
     box = np.arange(nbox) - nbox // 2
     # box = np.meshgrid(np.arange(nbox), np.arange(nbox))[0]-nbox//2
 
-    xobj, yobj = np.ogrid[0 : data["refband_height"], 0 : data["refband_width"]]
+    refshape = (data["refband_height"], data["refband_width"])
 
     # If the row-index of the central galaxy is not provided, use the source
     # nearest to the center of the field.
@@ -2079,47 +2290,41 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0, verbose=
         # Build the model image (of every object except the central)
         # on-the-fly. Need to be smarter about Tractor sources of resolved
         # structure (i.e., sources that "belong" to the central).
-        nocentral = np.delete(np.arange(len(tractor)), central)
-        srcs = tractor.copy()
-        srcs.cut(nocentral)
-        model_nocentral = srcs2image(
-            srcs,
+        model_nocentral = cached_srcs2image(
+            modelcache,
+            tractor,
+            central,
             data["{}_wcs".format(refband)],
             band=refband.lower(),
             pixelized_psf=data["{}_psf".format(refband)],
+            exclude=True,
         )
 
         # Mask all previous (brighter) central galaxies, if any.
         img, newmask = ma.getdata(data[refband]) - model_nocentral, ma.getmask(data[refband])
+        boxrows = np.array([int(yb + tractor.by[central]) for xb in box for yb in box])
+        boxcols = np.array([int(xb + tractor.bx[central]) for xb in box for yb in box])
+        prevmasks = []
         for jj in np.arange(ii):
             geo = data["mge"][jj]  # the previous galaxy
 
             # Do this step iteratively to capture the possibility where the
             # previous galaxy has masked the central pixels of the *current*
-            # galaxy, in each iteration reducing the size of the mask.
+            # galaxy, in each iteration reducing the size of the mask. Only
+            # the pixels around the current central need to be checked.
             for shrink in np.arange(0.1, 1.05, 0.05)[::-1]:
                 maxis = shrink * geo["majoraxis"]
-                _mask = ellipse_mask(
-                    geo["xmed"],
-                    geo["ymed"],
-                    maxis,
-                    maxis * (1 - geo["eps"]),
-                    np.radians(geo["theta"] - 90),
-                    xobj,
-                    yobj,
-                )
-                notok = False
-                for xb in box:
-                    for yb in box:
-                        if _mask[int(yb + tractor.by[central]), int(xb + tractor.bx[central])]:
-                            notok = True
-                            break
+                prevmask = (geo["xmed"], geo["ymed"], maxis, maxis * (1 - geo["eps"]), np.radians(geo["theta"] - 90))
+                notok = np.any(ellipse_mask(*prevmask, boxrows, boxcols))
                 if notok:
                     # if _mask[int(tractor.by[central]), int(tractor.bx[central])]:
                     print("The previous central has masked the current central with shrink factor {:.2f}".format(shrink))
                 else:
                     break
-            newmask = ma.mask_or(_mask, newmask)
+            prevmasks.append(prevmask)
+        if len(prevmasks) > 0:
+            # copy, so as not to modify the mask of the data
+            newmask = ellipse_mask_inplace(ma.getmaskarray(data[refband]).copy(), *np.transpose(prevmasks))
 
         # Next, get the basic galaxy geometry and pack it into a dictionary. If
         # the object of interest has been masked by, e.g., an adjacent star
@@ -2159,8 +2364,7 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0, verbose=
             maxis = 1.5 * tractor.shape_r[central] / filt2pixscale[refband]  # [pixels]
             theta = (270 - pa) % 180
 
-            fixmask = ellipse_mask(xmed, ymed, maxis, maxis * ba, np.radians(theta - 90), xobj, yobj)
-            newmask[fixmask] = ma.nomask
+            ellipse_mask_inplace(newmask, xmed, ymed, maxis, maxis * ba, np.radians(theta - 90), value=ma.nomask)
 
         # import matplotlib.pyplot as plt ; plt.clf()
         mgegalaxy = find_galaxy(
@@ -2168,6 +2372,7 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0, verbose=
             nblob=1,
             binning=3,
             level=minsb,
+            fast=True,
         )  # , plot=True)#, quiet=not verbose
         # plt.savefig('junk.png') ; pdb.set_trace()
 
@@ -2192,16 +2397,15 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0, verbose=
             while (maxis > prevmaxis) and (iiter < maxiter):
                 # print(prevmaxis, maxis, iiter, maxiter)
                 print("  r={:.2f} pixels".format(maxis))
-                fixmask = ellipse_mask(
+                ellipse_mask_inplace(
+                    newmask,
                     mgegalaxy.xmed,
                     mgegalaxy.ymed,
                     maxis,
                     maxis * (1 - mgegalaxy.eps),
                     np.radians(mgegalaxy.theta - 90),
-                    xobj,
-                    yobj,
+                    value=ma.nomask,
                 )
-                newmask[fixmask] = ma.nomask
                 mgegalaxy = find_galaxy(
                     ma.masked_array(img / filt2pixscale[refband] ** 2, newmask),
                     nblob=1,
@@ -2209,6 +2413,7 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0, verbose=
                     quiet=True,
                     plot=False,
                     level=minsb,
+                    fast=True,
                 )
                 prevmaxis = maxis.copy()
                 maxis = 1.2 * mgegalaxy.majoraxis  # [pixels]
@@ -2240,16 +2445,15 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0, verbose=
             mgegalaxy.theta = (270 - pa) % 180
             mgegalaxy.majoraxis = 2 * tractor.shape_r[central] / filt2pixscale[refband]  # [pixels]
             print("  r={:.2f} pixels".format(mgegalaxy.majoraxis))
-            fixmask = ellipse_mask(
+            ellipse_mask_inplace(
+                newmask,
                 mgegalaxy.xmed,
                 mgegalaxy.ymed,
                 mgegalaxy.majoraxis,
                 mgegalaxy.majoraxis * (1 - mgegalaxy.eps),
                 np.radians(mgegalaxy.theta - 90),
-                xobj,
-                yobj,
+                value=ma.nomask,
             )
-            newmask[fixmask] = ma.nomask
         else:
             largeshift = False
 
@@ -2296,6 +2500,7 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0, verbose=
         # requires more work.
 
         # for filt in [refband]:
+        centralmasks = {}  # build the central mask once per pixel scale
         for filt in bands:
             thispixscale = filt2pixscale[filt]
 
@@ -2307,15 +2512,16 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0, verbose=
             majoraxis = 1.5 * factor * mgegalaxy.majoraxis  # [pixels]
 
             # Grab the pixels belonging to this galaxy so we can unmask them below.
-            central_mask = ellipse_mask(
-                mge["xmed"] * factor,
-                mge["ymed"] * factor,
-                majoraxis,
-                majoraxis * (1 - mgegalaxy.eps),
-                np.radians(mgegalaxy.theta - 90),
-                xobj,
-                yobj,
-            )
+            if factor not in centralmasks:
+                centralmasks[factor] = ellipse_mask_inplace(
+                    np.zeros(refshape, bool),
+                    mge["xmed"] * factor,
+                    mge["ymed"] * factor,
+                    majoraxis,
+                    majoraxis * (1 - mgegalaxy.eps),
+                    np.radians(mgegalaxy.theta - 90),
+                )
+            central_mask = centralmasks[factor]
             if np.sum(central_mask) == 0:
                 print("No pixels belong to the central galaxy---this is bad!")
                 data["failed"] = True
@@ -2333,18 +2539,20 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0, verbose=
             # pdb.set_trace()
 
             # Need to be smarter about the srcs list...
-            srcs = tractor.copy()
-            srcs.cut(nocentral)
-            model_nocentral = srcs2image(
-                srcs,
+            model_nocentral = cached_srcs2image(
+                modelcache,
+                tractor,
+                central,
                 data["{}_wcs".format(refband)],
                 band=filt.lower(),
                 pixelized_psf=data["{}_psf".format(refband)],
+                exclude=True,
             )
 
             # Convert to surface brightness and 32-bit precision.
-            img = (ma.getdata(data[filt]) - model_nocentral) / thispixscale**2  # [nanomaggies/arcsec**2]
-            img = ma.masked_array(img.astype("f4"), mask)
+            img = ma.getdata(data[filt]) - model_nocentral
+            img /= thispixscale**2  # [nanomaggies/arcsec**2]
+            img = ma.masked_array(img.astype("f4", copy=False), mask)
             var = data["{}_var_".format(filt)] / thispixscale**4  # [nanomaggies**2/arcsec**4]
 
             # Fill with zeros, for fun--
@@ -2366,6 +2574,7 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0, verbose=
     return data
 
 
+@profiled("read_multiband", galaxyarg=True)
 def read_multiband(
     galaxy,
     galaxydir,
@@ -2386,7 +2595,7 @@ def read_multiband(
     from astropy.table import Table
     from astrometry.util.fits import fits_table
     from legacypipe.bits import MASKBITS
-    from legacyhalos.io import _get_psfsize_and_depth, _read_image_data
+    from legacyhalos.io import _get_psfsize_and_depth, _read_image_data, get_residual_mask_filename
 
     # Dictionary mapping between optical filter and filename coded up in
     # coadds.py, galex.py, and unwise.py, which depends on the project.
@@ -2507,7 +2716,14 @@ def read_multiband(
     )
 
     # Read the basic imaging data and masks.
-    data = _read_image_data(data, filt2imfile, starmask=starmask, fill_value=fill_value, verbose=verbose)
+    data = _read_image_data(
+        data,
+        filt2imfile,
+        starmask=starmask,
+        fill_value=fill_value,
+        residmaskfile=get_residual_mask_filename(galaxy, galaxydir, filesuffix),
+        verbose=verbose,
+    )
 
     # Figure out which galaxies we are going to ellipse-fit by iterating on all
     # the SGA sources in the field and gather the data we need.
@@ -2656,6 +2872,10 @@ def call_ellipse(
     verbose=False,
     debug=False,
     logfile=None,
+    pool=None,
+    sharedmem=False,
+    fastprofile=False,
+    float32=False,
 ):
     """Wrapper on legacyhalos.mpi.call_ellipse but with specific preparatory work
     and hooks for the SGA project.
@@ -2703,6 +2923,10 @@ def call_ellipse(
         verbose=verbose,
         debug=debug,
         logfile=logfile,
+        pool=pool,
+        sharedmem=sharedmem,
+        fastprofile=fastprofile,
+        float32=float32,
     )
 
 
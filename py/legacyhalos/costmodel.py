@@ -0,0 +1,203 @@
+"""
+legacyhalos.costmodel
+=====================
+
+Predict the run time of each galaxy from the timings of previous runs.
+
+The time spent on a galaxy depends on more than just its diameter: the width of
+the mosaic (which also sets the number of isophotes), the number of bandpasses,
+the number of Tractor sources, and the number of galaxies in the group all
+matter. Here we harvest the per-galaxy timings of a previous run, either from
+the per-galaxy logfiles (see mpi._done) or from the profiling logs (see
+legacyhalos.profiler), fit a simple log-linear regression, and use it to predict
+the cost of the galaxies which are left to do, e.g., as the weight of
+mpi.work_queue or to estimate the node-hours needed for a given sample.
+
+"""
+import os, re
+import numpy as np
+
+COST_FEATURES = ("LOGWIDTH", "NBAND", "LOGNSOURCE", "LOGMULT")
+
+# top-level (i.e., not nested) stages of the profiling logs
+PROFILE_STAGES = ("read_multiband", "ellipsefit_multiband", "write_ellipsefit")
+
+_FINISHED = re.compile(r"Finished galaxy \S+ in ([0-9.]+) minutes")
+
+
+def read_log_timings(galaxy, galaxydir, suffix="ellipse"):
+    """Harvest the time spent on each galaxy from its logfile.
+
+    galaxy, galaxydir - galaxy names and directories (see get_galaxy_galaxydir)
+    suffix - stage of the pipeline, i.e., the logfile is galaxydir/galaxy-suffix.log
+
+    Returns the wall time [minutes] of the last completed run of each galaxy,
+    or NaN if the logfile is missing or the galaxy never finished.
+
+    """
+    galaxy, galaxydir = np.atleast_1d(galaxy), np.atleast_1d(galaxydir)
+    minutes = np.zeros(len(galaxy)) + np.nan
+    for igal, (gal, gdir) in enumerate(zip(galaxy, galaxydir)):
+        logfile = os.path.join(gdir, "{}-{}.log".format(gal, suffix))
+        if not os.path.isfile(logfile):
+            continue
+        with open(logfile, "r") as log:
+            for line in log:
+                mm = _FINISHED.search(line)
+                if mm is not None:
+                    minutes[igal] = float(mm.group(1))
+    return minutes
+
+
+def read_profile_timings(profile, galaxy, stages=PROFILE_STAGES):
+    """Total wall time [minutes] spent on each galaxy from the profiling logs.
+
+    profile - stacked profiling logs (see profiler.read_profile)
+    galaxy - galaxy names
+    stages - stages to add up; nested stages must be left out so the time is
+      not double-counted
+
+    Galaxies without any profiling records are assigned NaN.
+
+    """
+    galaxy = np.atleast_1d(galaxy).astype(str)
+    minutes = np.zeros(len(galaxy)) + np.nan
+
+    keep = np.isin(np.asarray(profile["STAGE"]).astype(str), stages)
+    if np.sum(keep) == 0:
+        return minutes
+    uniq, inv = np.unique(np.asarray(profile["GALAXY"]).astype(str)[keep], return_inverse=True)
+    total = np.bincount(inv, weights=np.asarray(profile["WALL"], "f8")[keep], minlength=len(uniq)) / 60
+
+    idx = np.clip(np.searchsorted(uniq, galaxy), 0, len(uniq) - 1)
+    match = uniq[idx] == galaxy
+    minutes[match] = total[idx[match]]
+    return minutes
+
+
+def cost_features(width, nband, nsource=None, mult=None):
+    """Build the (ngal, len(COST_FEATURES)) design matrix of the cost model.
+
+    width - width of the mosaic [pixels] (see coadds._mosaic_width)
+    nband - number of bandpasses (scalar or one per galaxy)
+    nsource - optional number of Tractor sources (e.g., the NSOURCE column of
+      io.gather_psfsize_and_depth)
+    mult - optional group multiplicity (e.g., GROUP_MULT)
+
+    The number of isophotes scales with the width of the mosaic, so it is
+    folded into LOGWIDTH. Missing features are NaN, which fit_cost_model and
+    predict_cost replace with the mean of the training sample.
+
+    """
+    width = np.atleast_1d(width).astype("f8")
+    ngal = len(width)
+
+    features = np.zeros((ngal, len(COST_FEATURES))) + np.nan
+    features[:, 0] = np.log10(np.maximum(width, 1))
+    features[:, 1] = np.broadcast_to(nband, ngal)
+    if nsource is not None:
+        features[:, 2] = np.log10(1 + np.maximum(nsource, 0))
+    if mult is not None:
+        features[:, 3] = np.log10(np.maximum(mult, 1))
+    return features
+
+
+def fit_cost_model(features, minutes):
+    """Least-squares fit of log10(minutes) = c0 + features . c
+
+    features - design matrix (see cost_features)
+    minutes - wall time of each galaxy [minutes]; galaxies with NaN (or
+      non-positive) timings are not fit
+
+    Returns a dictionary with the coefficients (intercept first), the mean of
+    each feature, the rms scatter of the fit [dex], and the number of galaxies
+    fit. Features which are missing for, or constant over, the whole sample
+    (e.g., the number of bandpasses of a survey) are degenerate with the
+    intercept, so they get a zero coefficient.
+
+    """
+    features = np.atleast_2d(np.array(features, "f8"))
+    minutes = np.atleast_1d(minutes).astype("f8")
+
+    good = np.isfinite(minutes) * (minutes > 0)
+    nfit = np.sum(good)
+    if nfit == 0:
+        raise ValueError("No timings to fit.")
+
+    features = features[good]
+    mean = np.zeros(features.shape[1])
+    for ii in range(features.shape[1]):
+        ok = np.isfinite(features[:, ii])
+        if np.any(ok):
+            mean[ii] = np.mean(features[ok, ii])
+    features = np.where(np.isfinite(features), features, mean)
+
+    vary = np.hstack((True, np.ptp(features, axis=0) > 0))
+    A = np.hstack((np.ones((nfit, 1)), features))
+    y = np.log10(minutes[good])
+    coeff = np.zeros(A.shape[1])
+    coeff[vary] = np.linalg.lstsq(A[:, vary], y, rcond=None)[0]
+    rms = np.sqrt(np.mean((y - A.dot(coeff)) ** 2))
+
+    return {"coeff": coeff, "mean": mean, "rms": rms, "nfit": nfit}
+
+
+def predict_cost(model, features):
+    """Predicted (mean) wall time [minutes] of each galaxy.
+
+    The fit is in log10(minutes), so the prediction is corrected for the
+    scatter of the model in order to get the mean, not the median, time.
+
+    """
+    features = np.atleast_2d(np.array(features, "f8"))
+    features = np.where(np.isfinite(features), features, model["mean"])
+    logminutes = model["coeff"][0] + features.dot(model["coeff"][1:])
+    return 10 ** (logminutes + 0.5 * np.log(10) * model["rms"] ** 2)
+
+
+def simulate_work_queue(cost, nrank):
+    """Total time spent by each rank if the galaxies are handed out on demand,
+    largest first (see mpi.work_queue).
+
+    cost - predicted cost of each galaxy
+    nrank - number of MPI ranks
+
+    """
+    import heapq
+
+    load = [(0.0, rank) for rank in range(nrank)]
+    for cc in np.sort(np.atleast_1d(cost))[::-1]:
+        tt, rank = heapq.heappop(load)
+        heapq.heappush(load, (tt + cc, rank))
+
+    out = np.zeros(nrank)
+    for tt, rank in load:
+        out[rank] = tt
+    return out
+
+
+def write_cost_model(outfile, model):
+    """Write a fitted cost model to a small FITS table."""
+    import fitsio
+
+    out = np.zeros(len(COST_FEATURES) + 1, dtype=[("FEATURE", "S12"), ("COEFF", "f8"), ("MEAN", "f8")])
+    out["FEATURE"] = ("INTERCEPT",) + COST_FEATURES
+    out["COEFF"] = model["coeff"]
+    out["MEAN"][1:] = model["mean"]
+
+    hdr = [
+        {"name": "RMS", "value": model["rms"], "comment": "rms scatter of the fit [dex]"},
+        {"name": "NFIT", "value": int(model["nfit"]), "comment": "number of galaxies fit"},
+    ]
+    fitsio.write(outfile, out, header=hdr, extname="COSTMODEL", clobber=True)
+
+
+def read_cost_model(infile):
+    """Read a cost model written by write_cost_model."""
+    import fitsio
+
+    data, hdr = fitsio.read(infile, "COSTMODEL", header=True)
+    feature = np.char.strip(np.asarray(data["FEATURE"]).astype(str))
+    if tuple(feature[1:]) != COST_FEATURES:
+        raise ValueError("Cost model {} has features {} but {} were expected.".format(infile, feature[1:], COST_FEATURES))
+    return {"coeff": data["COEFF"].astype("f8"), "mean": data["MEAN"][1:].astype("f8"), "rms": hdr["RMS"], "nfit": hdr["NFIT"]}
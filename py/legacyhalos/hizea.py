@@ -11,6 +11,7 @@ import astropy
 from astropy.table import Table
 
 import legacyhalos.io
+from legacyhalos.profiler import profiled
 
 ZCOLUMN = "Z"
 RACOLUMN = "RA"  # 'RA'
@@ -94,6 +95,27 @@ def mpi_args():
     parser.add_argument("--debug", action="store_true", help="Log to STDOUT and build debugging plots.")
     parser.add_argument("--verbose", action="store_true", help="Enable verbose output.")
     parser.add_argument("--clobber", action="store_true", help="Overwrite existing files.")
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        help="Write per-stage timing and memory profiling logs (one per rank) to this directory.",
+    )
+    parser.add_argument(
+        "--sharedmem",
+        action="store_true",
+        help="Pass the images to the isophote-fitting pool via shared memory.",
+    )
+    parser.add_argument(
+        "--fastprofile",
+        action="store_true",
+        help="Extract the surface-brightness profiles with the vectorized fixed-geometry sampler.",
+    )
+    parser.add_argument(
+        "--float32",
+        action="store_true",
+        help="Do the elliptical aperture photometry in single precision.",
+    )
 
     parser.add_argument(
         "--build-refcat",
@@ -363,6 +385,7 @@ def build_catalog(sample, nproc=1, verbose=False):
     print("Wrote {} galaxies to {}".format(len(parent), outfile))
 
 
+@profiled("build_multiband_mask")
 def _build_multiband_mask(
     data,
     tractor,
@@ -386,21 +409,25 @@ def _build_multiband_mask(
     """
     import numpy.ma as ma
     from copy import copy
-    from skimage.transform import resize
     from legacyhalos.mge import find_galaxy
-    from legacyhalos.misc import srcs2image, ellipse_mask
+    from legacyhalos.misc import cached_srcs2image, ellipse_mask_inplace, resample_mask
 
     import matplotlib.pyplot as plt
     from astropy.visualization import simple_norm
 
     bands, refband = data["bands"], data["refband"]
+
+    # Per-source model stamps, rendered once per bandpass and reused for every
+    # central (see misc.cached_srcs2image).
+    modelcache = {}
+
     # residual_mask = data['residual_mask']
 
     # nbox = 5
     # box = np.arange(nbox)-nbox // 2
     # box = np.meshgrid(np.arange(nbox), np.arange(nbox))[0]-nbox//2
 
-    xobj, yobj = np.ogrid[0 : data["refband_height"], 0 : data["refband_width"]]
+    refshape = (data["refband_height"], data["refband_width"])
 
     # If the row-index of the central galaxy is not provided, use the source
     # nearest to the center of the field.
@@ -486,25 +513,23 @@ def _build_multiband_mask(
         # objmask = ellipse_mask(mgegalaxy.xmed, mgegalaxy.ymed, # object pixels are True
         #                       default_majoraxis, default_majoraxis, 0.0, xobj, yobj)
 
-        objmask = ellipse_mask(
+        objmask = ellipse_mask_inplace(
+            np.zeros(refshape, bool),
             mgegalaxy.xmed,
             mgegalaxy.ymed,  # object pixels are True
             mgegalaxy.majoraxis,
             mgegalaxy.majoraxis * (1 - mgegalaxy.eps),
             np.radians(mgegalaxy.theta - 90),
-            xobj,
-            yobj,
         )
 
         # central 10% pixels can override the starmask
-        objmask_center = ellipse_mask(
+        objmask_center = ellipse_mask_inplace(
+            np.zeros(refshape, bool),
             mgegalaxy.xmed,
             mgegalaxy.ymed,  # object pixels are True
             0.1 * mgegalaxy.majoraxis,
             0.1 * mgegalaxy.majoraxis * (1 - mgegalaxy.eps),
             np.radians(mgegalaxy.theta - 90),
-            xobj,
-            yobj,
         )
 
         return mgegalaxy, objmask, objmask_center
@@ -524,13 +549,17 @@ def _build_multiband_mask(
 
         iclose = np.where([centralmask[np.int(by), np.int(bx)] for by, bx in zip(tractor.by, tractor.bx)])[0]
 
+        nocentral = np.delete(np.arange(len(tractor)), iclose)
         srcs = tractor.copy()
-        srcs.cut(np.delete(np.arange(len(tractor)), iclose))
-        model = srcs2image(
-            srcs,
+        srcs.cut(nocentral)
+        model = cached_srcs2image(
+            modelcache,
+            tractor,
+            iclose,
             data["{}_wcs".format(refband.lower())],
             band=refband.lower(),
             pixelized_psf=data["{}_psf".format(refband.lower())],
+            exclude=True,
         )
 
         img = data[refband].data - model
@@ -630,11 +659,10 @@ def _build_multiband_mask(
                 # print('Warning! All satellites have been dropped from band {}!'.format(filt))
                 print("Note: no satellites to mask in band {}.".format(filt))
             else:
-                satsrcs = srcs.copy()
-                # satsrcs = tractor.copy()
-                satsrcs.cut(satindx)
-                satimg = srcs2image(
-                    satsrcs,
+                satimg = cached_srcs2image(
+                    modelcache,
+                    tractor,
+                    nocentral[satindx],
                     data["{}_wcs".format(filt.lower())],
                     band=filt.lower(),
                     pixelized_psf=data["{}_psf".format(filt.lower())],
@@ -645,7 +673,7 @@ def _build_multiband_mask(
                 #    #plt.clf() ; plt.imshow(data[filt], origin='lower') ; plt.savefig('junk-{}.png'.format(filt.lower()))
                 #    pdb.set_trace()
                 if satmask.shape != satimg.shape:
-                    thissatmask = resize(thissatmask * 1.0, satmask.shape, mode="reflect") > 0
+                    thissatmask = resample_mask(thissatmask, satmask.shape, smooth=True)
 
                 satmask = np.logical_or(satmask, thissatmask)
                 # if True:
@@ -663,11 +691,12 @@ def _build_multiband_mask(
         # subtract out the PSF sources. Then update the mask (but ignore the
         # residual mask). Finally convert to surface brightness.
         # for filt in ['W1']:
+        resizecache = {}  # resample the masks once per pixel scale
         for filt in bands:
             thismask = ma.getmask(data[filt])
             if satmask.shape != thismask.shape:
-                _satmask = (resize(satmask * 1.0, thismask.shape, mode="reflect") > 0) == 1.0
-                _centralmask = (resize(centralmask * 1.0, thismask.shape, mode="reflect") > 0) == 1.0
+                _satmask = resample_mask(satmask, thismask.shape, cache=resizecache, key="satmask", smooth=True)
+                _centralmask = resample_mask(centralmask, thismask.shape, cache=resizecache, key="centralmask", smooth=True)
                 mask = np.logical_or(thismask, _satmask)
                 mask[_centralmask] = False
             else:
@@ -700,8 +729,10 @@ def _build_multiband_mask(
                 psfsrcs = None
 
             if psfsrcs:
-                psfimg = srcs2image(
-                    psfsrcs,
+                psfimg = cached_srcs2image(
+                    modelcache,
+                    tractor,
+                    psfindx,
                     data["{}_wcs".format(filt.lower())],
                     band=filt.lower(),
                     pixelized_psf=data["{}_psf".format(filt.lower())],
@@ -755,6 +786,7 @@ def _build_multiband_mask(
     return data
 
 
+@profiled("read_multiband", galaxyarg=True)
 def read_multiband(
     galaxy,
     galaxydir,
@@ -781,7 +813,7 @@ def read_multiband(
     import astropy.units as u
     from astrometry.util.fits import fits_table
     from legacypipe.bits import MASKBITS
-    from legacyhalos.io import _get_psfsize_and_depth, _read_image_data
+    from legacyhalos.io import _get_psfsize_and_depth, _read_image_data, get_residual_mask_filename
 
     # galaxy_id = np.atleast_1d(galaxy_id)
     # if len(galaxy_id) > 1:
@@ -976,6 +1008,7 @@ def read_multiband(
         starmask=starmask,
         filt2pixscale=filt2pixscale,
         fill_value=fill_value,
+        residmaskfile=get_residual_mask_filename(galaxy, galaxydir, filesuffix),
         verbose=verbose,
     )
 
@@ -1053,6 +1086,10 @@ def call_ellipse(
     clobber=False,
     debug=False,
     logfile=None,
+    pool=None,
+    sharedmem=False,
+    fastprofile=False,
+    float32=False,
 ):
     """Wrapper on legacyhalos.mpi.call_ellipse but with specific preparatory work
     and hooks for the legacyhalos project.
@@ -1123,6 +1160,10 @@ def call_ellipse(
         verbose=verbose,
         debug=True,
         clobber=clobber,
+        pool=pool,
+        sharedmem=sharedmem,
+        fastprofile=fastprofile,
+        float32=float32,
     )  # debug, logfile=logfile)
 
 
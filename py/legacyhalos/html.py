@@ -217,6 +217,24 @@ def make_ccdpos_qa(
         print("Unable to make ccdpos QA; montage file {} not found.".format(grzfile))
 
 
+def make_thumbnail(infile, outfile, width, height=None):
+    """In-process equivalent of ImageMagick's convert -thumbnail WIDTHxHEIGHT
+    infile outfile, i.e., resize the image to fit within width x height pixels
+    (or to the given width, if height=None) preserving its aspect ratio.
+
+    """
+    from PIL import Image
+
+    Image.MAX_IMAGE_PIXELS = None
+
+    with Image.open(infile) as im:
+        scale = width / im.size[0]
+        if height is not None:
+            scale = min(scale, height / im.size[1])
+        size = (max(1, int(round(im.size[0] * scale))), max(1, int(round(im.size[1] * scale))))
+        im.resize(size, Image.LANCZOS).save(outfile)
+
+
 def make_montage_coadds(
     galaxy,
     galaxydir,
@@ -290,11 +308,10 @@ def make_montage_coadds(
                     resize = None
 
                 # Make a quick thumbnail of just the data.
-                cmd = "convert -thumbnail {0}x{0} {1} {2}".format(96, np.atleast_1d(jpgfile)[0], thumb2file)
                 if os.path.isfile(thumb2file):
                     os.remove(thumb2file)
                 print("Writing {}".format(thumb2file))
-                subprocess.call(cmd.split())
+                make_thumbnail(np.atleast_1d(jpgfile)[0], thumb2file, 96, 96)
 
                 # Add a bar and label to the first image.
                 if _just_coadds:
@@ -352,12 +369,10 @@ def make_montage_coadds(
                     continue
 
                 # Create a couple smaller thumbnail images
-                cmd = "convert -thumbnail {0} {1} {2}".format(thumbsz, montagefile, thumbfile)
-                # print(cmd)
                 if os.path.isfile(thumbfile):
                     os.remove(thumbfile)
                 print("Writing {}".format(thumbfile))
-                subprocess.call(cmd.split())
+                make_thumbnail(montagefile, thumbfile, thumbsz)
 
                 ## Create a couple smaller thumbnail images
                 # for tf, sz in zip((thumbfile, thumb2file), (512, 96)):
@@ -442,11 +457,10 @@ def make_multiwavelength_coadds(
                     resize = None
 
                 # Make a quick thumbnail of just the data.
-                cmd = "convert -thumbnail {0}x{0} {1} {2}".format(96, np.atleast_1d(jpgfile)[0], thumb2file)
                 if os.path.isfile(thumb2file):
                     os.remove(thumb2file)
                 print("Writing {}".format(thumb2file))
-                subprocess.call(cmd.split())
+                make_thumbnail(np.atleast_1d(jpgfile)[0], thumb2file, 96, 96)
 
                 # Add a bar and label to the first image.
                 if _just_coadds:
@@ -508,12 +522,10 @@ def make_multiwavelength_coadds(
                     continue
 
                 # Create a couple smaller thumbnail images
-                cmd = "convert -thumbnail {0} {1} {2}".format(thumbsz, montagefile, thumbfile)
-                # print(cmd)
                 if os.path.isfile(thumbfile):
                     os.remove(thumbfile)
                 print("Writing {}".format(thumbfile))
-                subprocess.call(cmd.split())
+                make_thumbnail(montagefile, thumbfile, thumbsz)
 
 
 def make_maskbits_qa(galaxy, galaxydir, htmlgalaxydir, clobber=False, verbose=False):
@@ -700,11 +712,10 @@ def make_ellipse_qa(
                             unwise=True,
                         )
                     # Create a thumbnail.
-                    cmd = "convert -thumbnail 1024x1024 {} {}".format(multibandfile, thumbfile)  # .replace('>', '\>')
                     if os.path.isfile(thumbfile):
                         os.remove(thumbfile)
                     print("Writing {}".format(thumbfile))
-                    subprocess.call(cmd.split())
+                    make_thumbnail(multibandfile, thumbfile, 1024, 1024)
 
             if galex:
                 multibandfile = os.path.join(
@@ -736,11 +747,10 @@ def make_ellipse_qa(
                             unwise=False,
                         )
                     # Create a thumbnail.
-                    cmd = "convert -thumbnail 1024x1024 {} {}".format(multibandfile, thumbfile)  # .replace('>', '\>')
                     if os.path.isfile(thumbfile):
                         os.remove(thumbfile)
                     print("Writing {}".format(thumbfile))
-                    subprocess.call(cmd.split())
+                    make_thumbnail(multibandfile, thumbfile, 1024, 1024)
 
             multibandfile = os.path.join(
                 htmlgalaxydir,
@@ -771,11 +781,10 @@ def make_ellipse_qa(
                     )
 
                 # Create a thumbnail.
-                cmd = "convert -thumbnail 1024x1024 {} {}".format(multibandfile, thumbfile)  # .replace('>', '\>')
                 if os.path.isfile(thumbfile):
                     os.remove(thumbfile)
                 print("Writing {}".format(thumbfile))
-                subprocess.call(cmd.split())
+                make_thumbnail(multibandfile, thumbfile, 1024, 1024)
 
             ## hack!
             # print('HACK!!!')
@@ -11,9 +11,11 @@ import numpy.ma as ma
 
 import fitsio
 import astropy.units as u
-from astropy.table import Table, Column
+from astropy.table import Table
 from astrometry.util.fits import fits_table
 
+from legacyhalos.profiler import profiled
+
 
 def legacyhalos_dir():
     if "LEGACYHALOS_DIR" not in os.environ:
@@ -84,13 +86,22 @@ def _missing_files_one(args):
     return missing_files_one(*args)
 
 
-def missing_files_one(checkfile, dependsfile, clobber):
+def missing_files_one(checkfile, dependsfile, clobber, exists=None):
+    """Status (todo, done, or fail) of a single galaxy.
+
+    exists - optional function which tells whether a file exists (default:
+      check on disk; see scan_missing_files)
+
+    """
     # def missing_files_one(galaxy, galaxydir, filesuffix, dependson, clobber):
     # checkfile = os.path.join(galaxydir, '{}{}'.format(galaxy, filesuffix))
     # print('missing_files_one: ', checkfile)
     # print(checkfile, dependsfile, clobber)
     from pathlib import Path
 
+    if exists is None:
+        exists = lambda filename: Path(filename).exists()
+
     # from glob import glob
     # if os.path.isfile(checkfile) and clobber is False:
     # checkfile = glob(checkfile)
@@ -98,13 +109,13 @@ def missing_files_one(checkfile, dependsfile, clobber):
     #    checkfile = checkfile[0]
     # else:
     #    checkfile = '_'
-    if Path(checkfile).exists() and clobber is False:
+    if exists(checkfile) and clobber is False:
         # Is the stage that this stage depends on done, too?
         # print(checkfile, dependsfile, clobber)
         if dependsfile is None:
             return "done"
         else:
-            if Path(dependsfile).exists():
+            if exists(dependsfile):
                 # if os.path.isfile(dependsfile):
                 return "done"
             else:
@@ -114,7 +125,7 @@ def missing_files_one(checkfile, dependsfile, clobber):
         # Did this object fail?
         if checkfile[-6:] == "isdone":
             failfile = checkfile[:-6] + "isfail"
-            if Path(failfile).exists():
+            if exists(failfile):
                 # if os.path.isfile(failfile):
                 if clobber is False:
                     return "fail"
@@ -132,7 +143,7 @@ def missing_files_one(checkfile, dependsfile, clobber):
             #        return 'todo'
         else:
             if dependsfile is not None:
-                if os.path.isfile(dependsfile):
+                if exists(dependsfile):
                     return "todo"
                 else:
                     print("Missing depends file {}".format(dependsfile))
@@ -143,6 +154,59 @@ def missing_files_one(checkfile, dependsfile, clobber):
         return "todo"
 
 
+def _list_dirs_one(parentdir, dirs):
+    """List the files in each of dirs (all of which are subdirectories of
+    parentdir), skipping the ones which are not in the listing of parentdir.
+
+    """
+    try:
+        with os.scandir(parentdir) as it:
+            present = set(entry.name for entry in it)
+    except (FileNotFoundError, NotADirectoryError):
+        return {}
+
+    files = {}
+    for thisdir in dirs:
+        if os.path.basename(thisdir) not in present:
+            continue
+        try:
+            with os.scandir(thisdir) as it:
+                files[thisdir] = set(entry.name for entry in it)
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+    return files
+
+
+def scan_missing_files(missargs, nthreads=8):
+    """Equivalent to calling missing_files_one on each element of missargs, but
+    rather than checking up to three files per galaxy, each (e.g., RA-slice)
+    directory and each existing galaxy directory is listed just once, by a pool
+    of threads, and the files are looked up in the listings.
+
+    missargs - list of [checkfile, dependsfile, clobber] arguments
+    nthreads - number of threads for listing the directories
+
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    dirs = {}
+    for checkfile, dependsfile, _ in missargs:
+        for filename in (checkfile, dependsfile):
+            if filename is not None:
+                thisdir = os.path.dirname(filename)
+                dirs.setdefault(os.path.dirname(thisdir), set()).add(thisdir)
+
+    files = {}
+    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+        for out in pool.map(lambda parentdir: _list_dirs_one(parentdir, dirs[parentdir]), list(dirs.keys())):
+            files.update(out)
+
+    def _exists(filename):
+        return os.path.basename(filename) in files.get(os.path.dirname(filename), ())
+
+    return np.array([missing_files_one(*_missargs, exists=_exists) for _missargs in missargs])
+
+
 def get_run(onegal, racolumn="RA", deccolumn="DEC"):
     """Get the run based on a simple declination cut."""
     if onegal[deccolumn] > 32.375:
@@ -283,6 +347,114 @@ def _get_ellipse_datamodel(
     return cols
 
 
+def _fits_unit(unit):
+    """FITS TUNIT string of an astropy unit (or unit string)."""
+    if unit is None:
+        return ""
+    if isinstance(unit, str):
+        return unit
+    return u.Unit(unit).to_string(format="fits")
+
+
+class EllipseDatamodel(object):
+    """Compiled version of the ellipse-fitting data model (see
+    _get_ellipse_datamodel), which packs an ellipsefit dictionary directly
+    into a one-row numpy structured array that fitsio can write in a single
+    call (i.e., without building an astropy Table column by column).
+
+    Use get_ellipse_datamodel to build (and reuse) one instance per
+    configuration.
+
+    """
+
+    def __init__(self, sbthresh, apertures, bands=["g", "r", "z"], add_datamodel_cols=None, copy_mw_transmission=False):
+        cols = _get_ellipse_datamodel(
+            sbthresh,
+            apertures,
+            bands=bands,
+            add_datamodel_cols=add_datamodel_cols,
+            copy_mw_transmission=copy_mw_transmission,
+        )
+        self.keys = [key for key, _ in cols]
+        self.units = [_fits_unit(unit) for _, unit in cols]
+        self._keyset = set(self.keys)
+        self._header = None
+
+    @property
+    def header(self):
+        """Output header (see legacyhalos_header) as a list of fitsio records."""
+        if self._header is None:
+            hdr = legacyhalos_header()
+            self._header = [dict(name=card.keyword, value=card.value, comment=card.comment) for card in hdr.cards]
+        return self._header
+
+    def pack(self, ellipsefit, galaxyinfo=None, galaxy=""):
+        """Pack an ellipsefit dictionary (preceded by the optional galaxyinfo
+        dictionary of (value, unit) pairs) into a one-row structured array
+        with upper-case column names.
+
+        Returns the structured array and the list of units of its columns.
+
+        """
+        keys, units, values = [], [], []
+        if galaxyinfo:
+            for key in galaxyinfo.keys():
+                keys.append(key)
+                values.append(galaxyinfo[key][0])
+                units.append(_fits_unit(galaxyinfo[key][1]))
+
+        for key, unit in zip(self.keys, self.units):
+            if key not in ellipsefit:
+                raise ValueError("Data model change -- no column {} for galaxy {}!".format(key, galaxy))
+            keys.append(key)
+            values.append(ellipsefit[key])
+            units.append(unit)
+
+        if len(set(ellipsefit.keys()) - self._keyset - set(keys)) > 0:
+            raise ValueError("Data model change -- non-documented columns have been added to ellipsefit dictionary!")
+
+        # scalars become scalar columns and arrays become (one-row) vector
+        # columns, as in an astropy Table of np.atleast_1d(scalar) and
+        # np.atleast_2d(array) columns
+        dtype = []
+        for ii, (key, data) in enumerate(zip(keys, values)):
+            if np.isscalar(data):
+                data = np.asarray(data)
+            else:
+                data = np.atleast_2d(data)[0]
+            values[ii] = data
+            dtype.append((key.upper(), data.dtype, data.shape))
+
+        rec = np.zeros(1, dtype=dtype)
+        for (name, _, _), data in zip(dtype, values):
+            rec[name][0] = data
+
+        return rec, units
+
+
+# compiled ellipse data models, one per configuration (see get_ellipse_datamodel)
+_ELLIPSE_DATAMODELS = dict()
+
+
+def get_ellipse_datamodel(sbthresh, apertures, bands=["g", "r", "z"], add_datamodel_cols=None, copy_mw_transmission=False):
+    """Return the compiled EllipseDatamodel of a given configuration, building it
+    the first time it is requested.
+
+    """
+    if add_datamodel_cols is not None:
+        add_datamodel_cols = tuple(tuple(col) for col in add_datamodel_cols)
+    key = (tuple(sbthresh), tuple(apertures), tuple(bands), add_datamodel_cols, bool(copy_mw_transmission))
+    if key not in _ELLIPSE_DATAMODELS:
+        _ELLIPSE_DATAMODELS[key] = EllipseDatamodel(
+            sbthresh,
+            apertures,
+            bands=bands,
+            add_datamodel_cols=None if add_datamodel_cols is None else list(add_datamodel_cols),
+            copy_mw_transmission=copy_mw_transmission,
+        )
+    return _ELLIPSE_DATAMODELS[key]
+
+
 def get_ellipsefit_filename(galaxy, galaxydir, filesuffix="", galaxy_id=""):
     if type(galaxy_id) is not str:
         galaxy_id = str(galaxy_id)
@@ -302,6 +474,7 @@ def get_ellipsefit_filename(galaxy, galaxydir, filesuffix="", galaxy_id=""):
     return ellipsefitfile
 
 
+@profiled("write_ellipsefit")
 def write_ellipsefit(
     galaxy,
     galaxydir,
@@ -322,10 +495,11 @@ def write_ellipsefit(
 
     ellipsefit - input dictionary
 
-    """
-    from astropy.io import fits
-    from astropy.table import Table
+    The dictionary is packed into a single-row table with the (cached)
+    compiled data model of this configuration (see get_ellipse_datamodel) and
+    written with fitsio in a single call.
 
+    """
     ellipsefitfile = get_ellipsefit_filename(galaxy, galaxydir, filesuffix=filesuffix, galaxy_id=galaxy_id)
 
     if sbthresh is None:
@@ -334,93 +508,24 @@ def write_ellipsefit(
     if apertures is None:
         from legacyhalos.ellipse import REF_APERTURES as apertures
 
-    # Turn the ellipsefit dictionary into a FITS table, starting with the
-    # galaxyinfo dictionary (if provided).
-    out = Table()
-    if galaxyinfo:
-        for key in galaxyinfo.keys():
-            data = galaxyinfo[key][0]
-            if np.isscalar(data):
-                data = np.atleast_1d(data)
-            else:
-                data = np.atleast_2d(data)
-            unit = galaxyinfo[key][1]  # add units
-            col = Column(name=key, data=data, dtype=data.dtype, unit=unit)
-            # if type(unit) is str:
-            # else:
-            #    #data *= unit
-            #    #data = u.Quantity(value=data, unit=unit, dtype=data.dtype)
-            #    col = Column(name=key, data=data, dtype=data.dtype)
-            out.add_column(col)
-
-    # First, unpack the nested dictionaries.
-    datadict = {}
-    for key in ellipsefit.keys():
-        # if type(ellipsefit[key]) is dict: # obsolete
-        #    for key2 in ellipsefit[key].keys():
-        #        datadict['{}_{}'.format(key, key2)] = ellipsefit[key][key2]
-        # else:
-        #    datadict[key] = ellipsefit[key]
-        datadict[key] = ellipsefit[key]
-    del ellipsefit
-
-    # Add to the data table
-    datakeys = datadict.keys()
-    for key, unit in _get_ellipse_datamodel(
+    datamodel = get_ellipse_datamodel(
         sbthresh,
         apertures,
         bands=bands,
         add_datamodel_cols=add_datamodel_cols,
         copy_mw_transmission=copy_mw_transmission,
-    ):
-        if key not in datakeys:
-            raise ValueError("Data model change -- no column {} for galaxy {}!".format(key, galaxy))
-        data = datadict[key]
-        if np.isscalar(data):  # or len(np.array(data)) > 1:
-            data = np.atleast_1d(data)
-        # elif len(data) == 0:
-        #    data = np.atleast_1d(data)
-        else:
-            data = np.atleast_2d(data)
-        # if type(unit) is not str:
-        #    data = u.Quantity(value=data, unit=unit, dtype=data.dtype)
-        # col = Column(name=key, data=data)
-        col = Column(name=key, data=data, dtype=data.dtype, unit=unit)
-        # if 'z_cog' in key:
-        #    print(key)
-        #    pdb.set_trace()
-        out.add_column(col)
-
-    if np.logical_not(np.all(np.isin([*datakeys], out.colnames))):
-        raise ValueError("Data model change -- non-documented columns have been added to ellipsefit dictionary!")
-
-    # uppercase!
-    for col in out.colnames:
-        out.rename_column(col, col.upper())
-
-    hdr = legacyhalos_header()
-
-    # for col in out.colnames:
-    #    print(col, out[col])
-
-    hdu = fits.convenience.table_to_hdu(out)
-    hdu.header["EXTNAME"] = "ELLIPSE"
-    hdu.header.update(hdr)
-    hdu.add_checksum()
-
-    hdu0 = fits.PrimaryHDU()
-    hdu0.header["EXTNAME"] = "PRIMARY"
-    hx = fits.HDUList([hdu0, hdu])
+    )
+    out, units = datamodel.pack(ellipsefit, galaxyinfo=galaxyinfo, galaxy=galaxy)
 
     if verbose:
         print("Writing {}".format(ellipsefitfile))
     tmpfile = ellipsefitfile + ".tmp"
-    hx.writeto(tmpfile, overwrite=True, checksum=True)
+    with fitsio.FITS(tmpfile, "rw", clobber=True) as ff:
+        ff.write(out, extname="ELLIPSE", header=datamodel.header, units=units)
+        ff[0].write_key("EXTNAME", "PRIMARY")
+        for hdu in ff:
+            hdu.write_checksum()
     os.rename(tmpfile, ellipsefitfile)
-    # hx.writeto(ellipsefitfile, overwrite=True, checksum=True)
-
-    # out.write(ellipsefitfile, overwrite=True)
-    # fitsio.write(ellipsefitfile, out.as_array(), extname='ELLIPSE', header=hdr, clobber=True)
 
 
 def read_ellipsefit(
@@ -432,8 +537,9 @@ def read_ellipsefit(
     asTable=False,
     ellipsefitfile=None,
 ):
-    """Read the output of write_ellipsefit. Convert the astropy Table into a
-    dictionary so we can use a bunch of legacy code.
+    """Read the output of write_ellipsefit. Convert the (one-row) table into a
+    dictionary so we can use a bunch of legacy code; the array-valued entries
+    are views into the table rather than copies.
 
     """
     if galaxy_id.strip() == "":
@@ -449,19 +555,14 @@ def read_ellipsefit(
         ellipsefitfile = os.path.join(galaxydir, "{}{}-ellipse{}.fits".format(galaxy, fsuff, galid))
 
     if os.path.isfile(ellipsefitfile):
-        data = Table(fitsio.read(ellipsefitfile))
+        data = fitsio.read(ellipsefitfile)
 
         # Optionally convert (back!) into a dictionary.
         if asTable:
-            return data
+            return Table(data)
         ellipsefit = {}
-        for key in data.colnames:
-            val = data[key][0]
-            # val = data[key].tolist()[0]
-            # if np.logical_not(np.isscalar(val)) and len(val) > 0:
-            #    val = np.array(val, dtype=data[key].dtype)
-            ellipsefit[key.lower()] = val  # lowercase!
-            # ellipsefit[key.lower()] = np.array(val, dtype=data[key].dtype)
+        for key in data.dtype.names:
+            ellipsefit[key.lower()] = data[key][0]  # lowercase!
     else:
         if verbose:
             print("File {} not found!".format(ellipsefitfile))
@@ -531,6 +632,178 @@ def write_sbprofile(sbprofile, smascale, sbfile):
     print("Wrote {}".format(sbfile))
 
 
+def _read_tractor_psf(tractorfile, bands):
+    """Read the columns of a Tractor catalog needed by gather_psfsize_and_depth."""
+    if not os.path.isfile(tractorfile):
+        print("Missing Tractor catalog {}".format(tractorfile))
+        return None
+    with fitsio.FITS(tractorfile) as F:
+        colnames = F[1].get_colnames()
+        columns = ["bx", "by"]
+        for filt in bands:
+            for col in ("psfsize_{}".format(filt.lower()), "psfdepth_{}".format(filt.lower())):
+                if col in colnames:
+                    columns.append(col)
+        return F[1].read(columns=columns)
+
+
+def _reduce_tractor_psf(tractorfile, bands, pixscale, incenter=False):
+    """Read one Tractor catalog and reduce it to the median PSF size and depth
+    of the galaxy (see gather_psfsize_and_depth), so the catalog itself can be
+    freed right away.
+
+    """
+    out = {}
+    for filt in bands:
+        for col in ("PSFSIGMA", "PSFSIZE", "PSFDEPTH"):
+            out["{}_{}".format(col, filt.upper())] = np.float32(0.0)
+
+    cat = _read_tractor_psf(tractorfile, bands)
+    if cat is None or len(cat) == 0:
+        return 0, out
+
+    # Optionally choose sources in the center of the field.
+    if incenter:
+        H = np.max(cat["bx"]) - np.min(cat["bx"])
+        dH = 0.1 * H
+        lo, hi = int(H / 2 - dH), int(H / 2 + dH)
+        these = (cat["bx"] >= lo) * (cat["bx"] <= hi) * (cat["by"] >= lo) * (cat["by"] <= hi)
+    else:
+        these = np.ones(len(cat), bool)
+
+    # missing columns are left at zero (i.e., no good measurements)
+    for filt in bands:
+        psfsizecol, psfdepthcol = "psfsize_{}".format(filt.lower()), "psfdepth_{}".format(filt.lower())
+        if psfsizecol in cat.dtype.names:
+            psfsize = cat[psfsizecol][these]  # [FWHM, arcsec]
+            psfsize = psfsize[psfsize > 0]
+            if len(psfsize) > 0:
+                psfsigma = psfsize / np.sqrt(8 * np.log(2)) / pixscale  # [sigma, pixels]
+                out["PSFSIGMA_{}".format(filt.upper())] = np.median(psfsigma).astype("f4")
+                out["PSFSIZE_{}".format(filt.upper())] = np.median(psfsize).astype("f4")
+        if psfdepthcol in cat.dtype.names:
+            psfdepth = cat[psfdepthcol][these]  # [1/nanomaggies**2]
+            psfdepth = psfdepth[psfdepth > 0]
+            if len(psfdepth) > 0:
+                out["PSFDEPTH_{}".format(filt.upper())] = (22.5 - 2.5 * np.log10(1 / np.sqrt(np.median(psfdepth)))).astype("f4")
+
+    return len(cat), out
+
+
+def gather_psfsize_and_depth(tractorfiles, bands, pixscale, galaxy=None, incenter=False, nthreads=8):
+    """Compute the PSF size and depth of a whole sample at once.
+
+    Equivalent to calling _get_psfsize_and_depth for each galaxy, but the
+    (needed columns of the) Tractor catalogs are read by a pool of threads,
+    each of which reduces its catalog to the medians of the galaxy before
+    reading the next one, so only nthreads catalogs are in memory at a time.
+
+    tractorfiles - list of Tractor catalogs, one per galaxy
+    bands - list of bandpasses
+    pixscale - pixel scale [arcsec/pixel]
+    galaxy - optional list of galaxy names (default: the catalog basenames)
+    incenter - only use the sources in the center of each field
+    nthreads - number of threads to use for reading the catalogs
+
+    Returns a table with one row per galaxy and PSFSIGMA_[BAND] [pixels],
+    PSFSIZE_[BAND] [FWHM, arcsec], and PSFDEPTH_[BAND] [5-sigma AB mag] columns,
+    which are zero if there are no good measurements (or the catalog is missing).
+
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    tractorfiles = np.atleast_1d(tractorfiles)
+    ngal = len(tractorfiles)
+    if galaxy is None:
+        galaxy = [os.path.basename(tractorfile).replace("-tractor.fits", "") for tractorfile in tractorfiles]
+
+    out = Table()
+    out["GALAXY"] = np.array(galaxy).astype(str)
+    out["TRACTORFILE"] = tractorfiles.astype(str)
+    out["NSOURCE"] = np.zeros(ngal, "i4")
+    for filt in bands:
+        for col in ("PSFSIGMA", "PSFSIZE", "PSFDEPTH"):
+            out["{}_{}".format(col, filt.upper())] = np.zeros(ngal, "f4")
+
+    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+        results = pool.map(lambda tractorfile: _reduce_tractor_psf(tractorfile, bands, pixscale, incenter), tractorfiles)
+        for igal, (nsource, psf) in enumerate(results):
+            out["NSOURCE"][igal] = nsource
+            for col, value in psf.items():
+                out[col][igal] = value
+
+    return out
+
+
+def get_residual_mask_filename(galaxy, galaxydir, filesuffix="custom"):
+    """Name of the residual-mask sidecar file written by _read_image_data."""
+    return os.path.join(galaxydir, "{}-{}-residual-mask.fits.fz".format(galaxy, filesuffix))
+
+
+def write_residual_mask(maskfile, residual_mask, sigma, verbose=False):
+    """Write the residual mask (bit-packed along rows and tile-compressed) and the
+    per-bandpass residual sigma (in the header) built by _read_image_data.
+
+    maskfile - output file name (see get_residual_mask_filename)
+    residual_mask - boolean residual mask (True-->bad, False-->good)
+    sigma - dictionary of the sigma-clipped residual sigma in each bandpass
+
+    """
+    hdr = fitsio.FITSHDR()
+    hdr.add_record(dict(name="MASKNX", value=residual_mask.shape[1], comment="number of (unpacked) columns"))
+    hdr.add_record(dict(name="BANDS", value=",".join(sigma.keys()), comment="bandpasses"))
+    for filt in sigma.keys():
+        hdr.add_record(
+            dict(name="SIG_{}".format(filt.upper()), value=float(sigma[filt]), comment="residual sigma in {}".format(filt))
+        )
+
+    # write to a temporary file and then rename, in case several processes are
+    # working on the same galaxy
+    tmpfile = maskfile.replace(".fits", ".tmp.fits")
+    fitsio.write(
+        tmpfile,
+        np.packbits(residual_mask, axis=1),
+        header=hdr,
+        extname="RESIDMASK",
+        compress="gzip",
+        clobber=True,
+    )
+    os.rename(tmpfile, maskfile)
+    if verbose:
+        print("Wrote {}".format(maskfile))
+
+
+def read_residual_mask(maskfile, bands, infiles=None, verbose=False):
+    """Read the output of write_residual_mask.
+
+    bands - bandpasses which must be present
+    infiles - optional list of input files from which the residual mask was
+      built; if any of them is newer than maskfile the cache is considered stale
+
+    Returns the residual mask and a dictionary of the residual sigma in each
+    bandpass, or (None, None) if the file is missing or stale.
+
+    """
+    if not os.path.isfile(maskfile):
+        return None, None
+    if infiles is not None:
+        mtime = os.path.getmtime(maskfile)
+        if np.any([os.path.getmtime(infile) > mtime for infile in infiles]):
+            if verbose:
+                print("Ignoring stale residual mask {}".format(maskfile))
+            return None, None
+
+    packed, hdr = fitsio.read(maskfile, ext="RESIDMASK", header=True)
+    if not np.all(np.isin(bands, hdr["BANDS"].split(","))):
+        return None, None
+    residual_mask = np.unpackbits(packed, axis=1, count=hdr["MASKNX"]).astype(bool)
+    sigma = {filt: hdr["SIG_{}".format(filt.upper())] for filt in bands}
+    if verbose:
+        print("Read {}".format(maskfile))
+
+    return residual_mask, sigma
+
+
 def _get_psfsize_and_depth(tractor, bands, pixscale, incenter=False):
     """Support function for read_multiband. Compute the average PSF size (in arcsec)
     and depth (in 5-sigma AB mags) in each bandpass based on the Tractor
@@ -584,6 +857,68 @@ def _get_psfsize_and_depth(tractor, bands, pixscale, incenter=False):
     return out
 
 
+class FitsImage(object):
+    """Read-only handle on a (possibly tile-compressed) FITS image.
+
+    read() returns a single copy of the pixels, already converted to dtype, so
+    reading a large image does not also allocate a (native) temporary.
+    Uncompressed images are memory-mapped and converted directly; compressed
+    (.fits.fz) images are read with fitsio.
+
+    filename - FITS file name
+    ext - extension to read (default: the first image extension with data)
+    dtype - output data type
+
+    """
+
+    _BITPIX2DTYPE = {8: ">u1", 16: ">i2", 32: ">i4", 64: ">i8", -32: ">f4", -64: ">f8"}
+
+    def __init__(self, filename, ext=None, dtype=np.float32):
+        self.filename = filename
+        self.ext = ext
+        self.dtype = dtype
+        self._header = None
+        self._shape = None
+        self._memmap = None
+
+    def _init(self):
+        # Find the extension and, if possible, memory-map its data.
+        if self._shape is not None:
+            return
+        with fitsio.FITS(self.filename) as F:
+            if self.ext is None:
+                self.ext = [hdu.get_extnum() for hdu in F if hdu.has_data() and hdu.get_exttype() == "IMAGE_HDU"][0]
+            hdu = F[self.ext]
+            self._header = hdu.read_header()
+            self._shape = tuple(hdu.get_dims())
+            compressed = hdu.is_compressed()
+            datastart = hdu.get_offsets()["data_start"]
+
+        bitpix = self._header.get("BITPIX")
+        scaled = self._header.get("BSCALE", 1) != 1 or self._header.get("BZERO", 0) != 0
+        if not compressed and not scaled and bitpix in self._BITPIX2DTYPE:
+            self._memmap = np.memmap(
+                self.filename, dtype=self._BITPIX2DTYPE[bitpix], mode="r", offset=datastart, shape=self._shape
+            )
+
+    @property
+    def header(self):
+        self._init()
+        return self._header
+
+    @property
+    def shape(self):
+        self._init()
+        return self._shape
+
+    def read(self):
+        """Read (and return a copy of) the full image."""
+        self._init()
+        if self._memmap is not None:
+            return np.array(self._memmap, dtype=self.dtype)
+        return np.asarray(fitsio.read(self.filename, ext=self.ext), dtype=self.dtype)
+
+
 def _read_image_data(
     data,
     filt2imfile,
@@ -591,6 +926,8 @@ def _read_image_data(
     allmask=None,
     fill_value=0.0,
     filt2pixscale=None,
+    dtype=np.float32,
+    residmaskfile=None,
     verbose=False,
 ):
     """Helper function for the project-specific read_multiband method.
@@ -599,16 +936,25 @@ def _read_image_data(
     dictionary. Also create an initial pixel-level mask and handle images with
     different pixel scales (e.g., GALEX and WISE images).
 
+    The images are read one bandpass at a time (see FitsImage) and converted to
+    dtype, and the model and inverse variance images are freed as soon as the
+    residual mask and variance image have been computed.
+
+    If residmaskfile is given, the residual mask and the per-bandpass residual
+    sigma are read from this file (and the model images are not read at all)
+    or, if it does not exist or is older than the input images, written to it
+    (see write_residual_mask) for subsequent calls.
+
     """
     from astropy.stats import sigma_clipped_stats
     from scipy.ndimage.morphology import binary_dilation
     from scipy.ndimage.filters import gaussian_filter
-    from skimage.transform import resize
 
     from tractor.psf import PixelizedPSF
     from tractor.tractortime import TAITime
     from astrometry.util.util import Tan
     from legacypipe.survey import LegacySurveyWcs, ConstantFitsWcs
+    from legacyhalos.misc import resample_mask
 
     bands, refband = data["bands"], data["refband"]
 
@@ -617,17 +963,28 @@ def _read_image_data(
 
     vega2ab = {"W1": 2.699, "W2": 3.339, "W3": 5.174, "W4": 6.620}
 
+    # Read the cached residual mask, if available.
+    cached_residual_mask, cached_sigma = None, None
+    if residmaskfile is not None:
+        infiles = [filt2imfile[filt][imtype] for filt in bands for imtype in ("image", "model")]
+        cached_residual_mask, cached_sigma = read_residual_mask(residmaskfile, bands, infiles=infiles, verbose=verbose)
+
     # Loop on each filter and return the masked data.
-    residual_mask = None
+    residual_mask, sigma = None, {}
+    resizecache = {}  # resample the starmask once per pixel scale
     for filt in bands:
         # Read the data and initialize the mask with the inverse variance image,
         # if available.
         if verbose:
             print("Reading {}".format(filt2imfile[filt]["image"]))
-            print("Reading {}".format(filt2imfile[filt]["model"]))
-        image = fitsio.read(filt2imfile[filt]["image"])
+        image = FitsImage(filt2imfile[filt]["image"], dtype=dtype).read()
         hdr = fitsio.read_header(filt2imfile[filt]["image"], ext=1)
-        model = fitsio.read(filt2imfile[filt]["model"])
+        if cached_sigma is None:
+            if verbose:
+                print("Reading {}".format(filt2imfile[filt]["model"]))
+            model = FitsImage(filt2imfile[filt]["model"], dtype=dtype).read()
+        else:
+            model = None
 
         # add the header to the data dictionary
         data["{}_header".format(filt.lower())] = hdr
@@ -636,7 +993,7 @@ def _read_image_data(
         if "invvar" in filt2imfile[filt].keys():
             if verbose:
                 print("Reading {}".format(filt2imfile[filt]["invvar"]))
-            invvar = fitsio.read(filt2imfile[filt]["invvar"])
+            invvar = FitsImage(filt2imfile[filt]["invvar"], dtype=dtype).read()
             mask = invvar <= 0  # True-->bad, False-->good
         else:
             invvar = None
@@ -646,7 +1003,8 @@ def _read_image_data(
         # https://www.legacysurvey.org/dr9/description/#photometry
         if filt.lower() == "w1" or filt.lower() == "w2" or filt.lower() == "w3" or filt.lower() == "w4":
             image *= 10 ** (-0.4 * vega2ab[filt])
-            model *= 10 ** (-0.4 * vega2ab[filt])
+            if model is not None:
+                model *= 10 ** (-0.4 * vega2ab[filt])
             if invvar is not None:
                 invvar /= (10 ** (-0.4 * vega2ab[filt])) ** 2
 
@@ -683,7 +1041,7 @@ def _read_image_data(
         # scale. Never resize allmask (it's only for the optical).
         if starmask is not None:
             if doresize:
-                _starmask = resize(starmask, mask.shape, mode="edge", anti_aliasing=False) > 0
+                _starmask = resample_mask(starmask, mask.shape, cache=resizecache, key="starmask")
                 mask = np.logical_or(mask, _starmask)
             else:
                 mask = np.logical_or(mask, starmask)
@@ -693,20 +1051,27 @@ def _read_image_data(
         # Flag significant residual pixels after subtracting *all* the models
         # (we will restore the pixels of the galaxies of interest later). Only
         # consider the optical (grz) bands here.
-        resid = gaussian_filter(image - model, 2.0)
-        _, _, sig = sigma_clipped_stats(resid, sigma=3.0)
-        data["{}_sigma".format(filt.lower())] = sig
-        if residual_mask is None:
-            residual_mask = np.abs(resid) > 5 * sig
+        if model is None:
+            sig = cached_sigma[filt]
         else:
-            _residual_mask = np.abs(resid) > 5 * sig
-            # In grz, use a cumulative residual mask. In UV/IR use an
-            # individual-band mask.
-            if doresize:
-                pass
-                # residual_mask = resize(_residual_mask, residual_mask.shape, mode='reflect')
+            np.subtract(image, model, out=model)
+            resid = gaussian_filter(model, 2.0)
+            del model
+            _, _, sig = sigma_clipped_stats(resid, sigma=3.0)
+            if residual_mask is None:
+                residual_mask = np.abs(resid) > 5 * sig
             else:
-                residual_mask = np.logical_or(residual_mask, _residual_mask)
+                _residual_mask = np.abs(resid) > 5 * sig
+                # In grz, use a cumulative residual mask. In UV/IR use an
+                # individual-band mask.
+                if doresize:
+                    pass
+                    # residual_mask = resize(_residual_mask, residual_mask.shape, mode='reflect')
+                else:
+                    residual_mask = np.logical_or(residual_mask, _residual_mask)
+            del resid
+        data["{}_sigma".format(filt.lower())] = sig
+        sigma[filt] = sig
 
         ## Dilate the mask, mask out a 10% border, and pack into a dictionary.
         mask = binary_dilation(mask, iterations=2)
@@ -724,14 +1089,24 @@ def _read_image_data(
         #    pdb.set_trace()
 
         if invvar is not None:
-            var = np.zeros_like(invvar)
-            ok = invvar > 0
-            var[ok] = 1 / invvar[ok]
-            data["{}_var_".format(filt.lower())] = var  # [nanomaggies**2]
-            # data['{}_var'.format(filt.lower())] = var / thispixscale**4 # [nanomaggies**2/arcsec**4]
             if np.any(invvar < 0):
                 print("Warning! Negative pixels in the {}-band inverse variance map!".format(filt))
                 # pdb.set_trace()
+            # invert in place
+            ok = invvar > 0
+            var = np.divide(1, invvar, out=invvar, where=ok)
+            var[~ok] = 0
+            data["{}_var_".format(filt.lower())] = var  # [nanomaggies**2]
+            # data['{}_var'.format(filt.lower())] = var / thispixscale**4 # [nanomaggies**2/arcsec**4]
+            del invvar, ok
+
+    if cached_residual_mask is not None:
+        residual_mask = cached_residual_mask
+    elif residmaskfile is not None:
+        try:
+            write_residual_mask(residmaskfile, residual_mask, sigma, verbose=verbose)
+        except OSError as err:
+            print("Unable to write {}: {}".format(residmaskfile, err))
 
     data["residual_mask"] = residual_mask
     if starmask is not None:
@@ -11,6 +11,7 @@ import astropy
 import fitsio
 
 import legacyhalos.io
+from legacyhalos.profiler import profiled
 
 RACOLUMN = "RA"
 DECCOLUMN = "DEC"
@@ -337,6 +338,27 @@ def mpi_args():
     parser.add_argument("--debug", action="store_true", help="Log to STDOUT and build debugging plots.")
     parser.add_argument("--verbose", action="store_true", help="Enable verbose output.")
     parser.add_argument("--clobber", action="store_true", help="Overwrite existing files.")
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        help="Write per-stage timing and memory profiling logs (one per rank) to this directory.",
+    )
+    parser.add_argument(
+        "--sharedmem",
+        action="store_true",
+        help="Pass the images to the isophote-fitting pool via shared memory.",
+    )
+    parser.add_argument(
+        "--fastprofile",
+        action="store_true",
+        help="Extract the surface-brightness profiles with the vectorized fixed-geometry sampler.",
+    )
+    parser.add_argument(
+        "--float32",
+        action="store_true",
+        help="Do the elliptical aperture photometry in single precision.",
+    )
 
     parser.add_argument(
         "--build-refcat",
@@ -855,6 +877,7 @@ def read_redmapper(
         return cen
 
 
+@profiled("build_multiband_mask")
 def _build_multiband_mask(
     data,
     tractor,
@@ -876,19 +899,24 @@ def _build_multiband_mask(
     import numpy.ma as ma
     from copy import copy
     from legacyhalos.mge import find_galaxy
-    from legacyhalos.misc import srcs2image, ellipse_mask
+    from legacyhalos.misc import cached_srcs2image, ellipse_mask_inplace
 
     import matplotlib.pyplot as plt
     from astropy.visualization import simple_norm
 
     bands, refband = data["bands"], data["refband"]
+
+    # Per-source model stamps, rendered once per bandpass and reused for every
+    # central (see misc.cached_srcs2image).
+    modelcache = {}
+
     # residual_mask = data['residual_mask']
 
     # nbox = 5
     # box = np.arange(nbox)-nbox // 2
     # box = np.meshgrid(np.arange(nbox), np.arange(nbox))[0]-nbox//2
 
-    xobj, yobj = np.ogrid[0 : data["refband_height"], 0 : data["refband_width"]]
+    refshape = (data["refband_height"], data["refband_width"])
 
     # If the row-index of the central galaxy is not provided, use the source
     # nearest to the center of the field.
@@ -934,14 +962,13 @@ def _build_multiband_mask(
         mgegalaxy.theta = (270 - pa) % 180
         mgegalaxy.majoraxis = factor * tractor.shape_r[indx] / filt2pixscale[refband]  # [pixels]
 
-        objmask = ellipse_mask(
+        objmask = ellipse_mask_inplace(
+            np.zeros(refshape, bool),
             mgegalaxy.xmed,
             mgegalaxy.ymed,  # object pixels are True
             mgegalaxy.majoraxis,
             mgegalaxy.majoraxis * (1 - mgegalaxy.eps),
             np.radians(mgegalaxy.theta - 90),
-            xobj,
-            yobj,
         )
 
         return mgegalaxy, objmask
@@ -960,13 +987,17 @@ def _build_multiband_mask(
 
         iclose = np.where([centralmask[np.int(by), np.int(bx)] for by, bx in zip(tractor.by, tractor.bx)])[0]
 
+        nocentral = np.delete(np.arange(len(tractor)), iclose)
         srcs = tractor.copy()
-        srcs.cut(np.delete(np.arange(len(tractor)), iclose))
-        model = srcs2image(
-            srcs,
+        srcs.cut(nocentral)
+        model = cached_srcs2image(
+            modelcache,
+            tractor,
+            iclose,
             data["{}_wcs".format(refband)],
             band=refband.lower(),
             pixelized_psf=data["{}_psf".format(refband)],
+            exclude=True,
         )
 
         img = data[refband].data - model
@@ -1055,11 +1086,10 @@ def _build_multiband_mask(
             if len(satindx) == 0:
                 raise ValueError("All satellites have been dropped!")
 
-            satsrcs = srcs.copy()
-            # satsrcs = tractor.copy()
-            satsrcs.cut(satindx)
-            satimg = srcs2image(
-                satsrcs,
+            satimg = cached_srcs2image(
+                modelcache,
+                tractor,
+                nocentral[satindx],
                 data["{}_wcs".format(filt)],
                 band=filt.lower(),
                 pixelized_psf=data["{}_psf".format(filt)],
@@ -1088,8 +1118,10 @@ def _build_multiband_mask(
 
             img = ma.getdata(data[filt]).copy()
             if psfsrcs:
-                psfimg = srcs2image(
-                    psfsrcs,
+                psfimg = cached_srcs2image(
+                    modelcache,
+                    tractor,
+                    psfindx,
                     data["{}_wcs".format(filt)],
                     band=filt.lower(),
                     pixelized_psf=data["{}_psf".format(filt)],
@@ -1118,6 +1150,7 @@ def _build_multiband_mask(
     return data
 
 
+@profiled("read_multiband", galaxyarg=True)
 def read_multiband(
     galaxy,
     galaxydir,
@@ -1139,7 +1172,7 @@ def read_multiband(
     from astropy.table import Table
     from astrometry.util.fits import fits_table
     from legacypipe.bits import MASKBITS
-    from legacyhalos.io import _get_psfsize_and_depth, _read_image_data
+    from legacyhalos.io import _get_psfsize_and_depth, _read_image_data, get_residual_mask_filename
 
     # galaxy_id = np.atleast_1d(galaxy_id)
     # if len(galaxy_id) > 1:
@@ -1285,7 +1318,14 @@ def read_multiband(
             data["sky"].append(subsky)
 
     # Read the basic imaging data and masks.
-    data = _read_image_data(data, filt2imfile, starmask=starmask, fill_value=fill_value, verbose=verbose)
+    data = _read_image_data(
+        data,
+        filt2imfile,
+        starmask=starmask,
+        fill_value=fill_value,
+        residmaskfile=get_residual_mask_filename(galaxy, galaxydir, filesuffix),
+        verbose=verbose,
+    )
 
     # Find the central.
     samplefile = os.path.join(galaxydir, "{}-{}.fits".format(galaxy, filt2imfile["sample"]))
@@ -1350,6 +1390,10 @@ def call_ellipse(
     verbose=False,
     debug=False,
     logfile=None,
+    pool=None,
+    sharedmem=False,
+    fastprofile=False,
+    float32=False,
 ):
     """Wrapper on legacyhalos.mpi.call_ellipse but with specific preparatory work
     and hooks for the legacyhalos project.
@@ -1427,6 +1471,10 @@ def call_ellipse(
                     write_donefile=False,
                     verbose=verbose,
                     debug=True,
+                    pool=pool,
+                    sharedmem=sharedmem,
+                    fastprofile=fastprofile,
+                    float32=float32,
                 )  # , logfile=logfile)# no logfile and debug=True, otherwise this will crash
 
                 # no need to redo the nominal ellipse-fitting
@@ -1494,6 +1542,10 @@ def call_ellipse(
             verbose=verbose,
             debug=debug,
             logfile=logfile,
+            pool=pool,
+            sharedmem=sharedmem,
+            fastprofile=fastprofile,
+            float32=float32,
         )
 
 
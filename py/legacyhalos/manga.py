@@ -10,6 +10,7 @@ import numpy as np
 import astropy
 
 import legacyhalos.io
+from legacyhalos.profiler import profiled
 
 ZCOLUMN = "Z"
 RACOLUMN = "IFURA"  # 'RA'
@@ -109,6 +110,27 @@ def mpi_args():
     parser.add_argument("--debug", action="store_true", help="Log to STDOUT and build debugging plots.")
     parser.add_argument("--verbose", action="store_true", help="Enable verbose output.")
     parser.add_argument("--clobber", action="store_true", help="Overwrite existing files.")
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        help="Write per-stage timing and memory profiling logs (one per rank) to this directory.",
+    )
+    parser.add_argument(
+        "--sharedmem",
+        action="store_true",
+        help="Pass the images to the isophote-fitting pool via shared memory.",
+    )
+    parser.add_argument(
+        "--fastprofile",
+        action="store_true",
+        help="Extract the surface-brightness profiles with the vectorized fixed-geometry sampler.",
+    )
+    parser.add_argument(
+        "--float32",
+        action="store_true",
+        help="Do the elliptical aperture photometry in single precision.",
+    )
 
     parser.add_argument(
         "--build-refcat",
@@ -1528,6 +1550,7 @@ def build_catalog(sample, nproc=1, refcat="R1", resampled=False, verbose=False,
     print("Wrote {} galaxies to {}".format(len(sample), outfile))
 
 
+@profiled("build_multiband_mask")
 def _build_multiband_mask(
     data,
     tractor,
@@ -1550,21 +1573,25 @@ def _build_multiband_mask(
     """
     import numpy.ma as ma
     from copy import copy
-    from skimage.transform import resize
     from legacyhalos.mge import find_galaxy
-    from legacyhalos.misc import srcs2image, ellipse_mask
+    from legacyhalos.misc import cached_srcs2image, ellipse_mask_inplace, resample_mask
 
     import matplotlib.pyplot as plt
     from astropy.visualization import simple_norm
 
     bands, refband = data["bands"], data["refband"]
+
+    # Per-source model stamps, rendered once per bandpass and reused for every
+    # central (see misc.cached_srcs2image).
+    modelcache = {}
+
     # residual_mask = data['residual_mask']
 
     # nbox = 5
     # box = np.arange(nbox)-nbox // 2
     # box = np.meshgrid(np.arange(nbox), np.arange(nbox))[0]-nbox//2
 
-    xobj, yobj = np.ogrid[0 : data["refband_height"], 0 : data["refband_width"]]
+    refshape = (data["refband_height"], data["refband_width"])
     dims = data[refband].shape
     assert dims[0] == dims[1]
 
@@ -1639,14 +1666,13 @@ def _build_multiband_mask(
         # by default, restore all the pixels within 10% of the nominal IFU
         # footprint, assuming a circular geometry.
         default_majoraxis = 1.1 * MANGA_RADIUS / 2 / filt2pixscale[refband]  # [pixels]
-        objmask = ellipse_mask(
+        objmask = ellipse_mask_inplace(
+            np.zeros(refshape, bool),
             mgegalaxy.xmed,
             mgegalaxy.ymed,  # object pixels are True
             default_majoraxis,
             default_majoraxis,
             0.0,
-            xobj,
-            yobj,
         )
         # objmask = ellipse_mask(mgegalaxy.xmed, mgegalaxy.ymed, # object pixels are True
         #                       mgegalaxy.majoraxis,
@@ -1673,13 +1699,17 @@ def _build_multiband_mask(
 
         iclose = np.where([centralmask[np.int(by), np.int(bx)] for by, bx in zip(tractor.by, tractor.bx)])[0]
 
+        nocentral = np.delete(np.arange(len(tractor)), iclose)
         srcs = tractor.copy()
-        srcs.cut(np.delete(np.arange(len(tractor)), iclose))
-        model = srcs2image(
-            srcs,
+        srcs.cut(nocentral)
+        model = cached_srcs2image(
+            modelcache,
+            tractor,
+            iclose,
             data["{}_wcs".format(refband.lower())],
             band=refband.lower(),
             pixelized_psf=data["{}_psf".format(refband.lower())],
+            exclude=True,
         )
 
         img = data[refband].data - model
@@ -1816,11 +1846,10 @@ def _build_multiband_mask(
                 # raise ValueError('All satellites have been dropped!')
                 print("Warning! All satellites have been dropped from band {}!".format(filt))
             else:
-                satsrcs = srcs.copy()
-                # satsrcs = tractor.copy()
-                satsrcs.cut(satindx)
-                satimg = srcs2image(
-                    satsrcs,
+                satimg = cached_srcs2image(
+                    modelcache,
+                    tractor,
+                    nocentral[satindx],
                     data["{}_wcs".format(filt.lower())],
                     band=filt.lower(),
                     pixelized_psf=data["{}_psf".format(filt.lower())],
@@ -1831,7 +1860,7 @@ def _build_multiband_mask(
                 #    #plt.clf() ; plt.imshow(data[filt], origin='lower') ; plt.savefig('junk-{}.png'.format(filt.lower()))
                 #    pdb.set_trace()
                 if satmask.shape != satimg.shape:
-                    thissatmask = resize(thissatmask * 1.0, satmask.shape, mode="reflect") > 0
+                    thissatmask = resample_mask(thissatmask, satmask.shape, smooth=True)
 
                 satmask = np.logical_or(satmask, thissatmask)
                 # if True:
@@ -1849,11 +1878,12 @@ def _build_multiband_mask(
         # subtract out the PSF sources. Then update the mask (but ignore the
         # residual mask). Finally convert to surface brightness.
         # for filt in ['W1']:
+        resizecache = {}  # resample the masks once per pixel scale
         for filt in bands:
             thismask = ma.getmask(data[filt])
             if satmask.shape != thismask.shape:
-                _satmask = (resize(satmask * 1.0, thismask.shape, mode="reflect") > 0) == 1.0
-                _centralmask = (resize(centralmask * 1.0, thismask.shape, mode="reflect") > 0) == 1.0
+                _satmask = resample_mask(satmask, thismask.shape, cache=resizecache, key="satmask", smooth=True)
+                _centralmask = resample_mask(centralmask, thismask.shape, cache=resizecache, key="centralmask", smooth=True)
                 mask = np.logical_or(thismask, _satmask)
                 mask[_centralmask] = False
             else:
@@ -1884,8 +1914,10 @@ def _build_multiband_mask(
                 psfsrcs = None
 
             if psfsrcs:
-                psfimg = srcs2image(
-                    psfsrcs,
+                psfimg = cached_srcs2image(
+                    modelcache,
+                    tractor,
+                    psfindx,
                     data["{}_wcs".format(filt.lower())],
                     band=filt.lower(),
                     pixelized_psf=data["{}_psf".format(filt.lower())],
@@ -1939,6 +1971,7 @@ def _build_multiband_mask(
     return data
 
 
+@profiled("read_multiband", galaxyarg=True)
 def read_multiband(
     galaxy,
     galaxydir,
@@ -1965,7 +1998,7 @@ def read_multiband(
     import astropy.units as u
     from astrometry.util.fits import fits_table
     from legacypipe.bits import MASKBITS
-    from legacyhalos.io import _get_psfsize_and_depth, _read_image_data
+    from legacyhalos.io import _get_psfsize_and_depth, _read_image_data, get_residual_mask_filename
 
     # galaxy_id = np.atleast_1d(galaxy_id)
     # if len(galaxy_id) > 1:
@@ -2165,6 +2198,7 @@ def read_multiband(
         starmask=starmask,
         filt2pixscale=filt2pixscale,
         fill_value=fill_value,
+        residmaskfile=get_residual_mask_filename(galaxy, galaxydir, filesuffix),
         verbose=verbose,
     )
 
@@ -2242,6 +2276,10 @@ def call_ellipse(
     clobber=False,
     debug=False,
     logfile=None,
+    pool=None,
+    sharedmem=False,
+    fastprofile=False,
+    float32=False,
 ):
     """Wrapper on legacyhalos.mpi.call_ellipse but with specific preparatory work
     and hooks for the legacyhalos project.
@@ -2315,6 +2353,10 @@ def call_ellipse(
         # debug=True,
         debug=debug,
         logfile=logfile,
+        pool=pool,
+        sharedmem=sharedmem,
+        fastprofile=fastprofile,
+        float32=float32,
     )
 
 
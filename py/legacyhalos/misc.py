@@ -46,21 +46,18 @@ def imagetool_inspect(cat, group=False):
             ff.write("{} {:.6f} {:.6f}\n".format(gal, ra, dec))
 
 
-def srcs2image(cat, wcs, band="r", allbands="grz", pixelized_psf=None, psf_sigma=1.0):
-    """Build a model image from a Tractor catalog or a list of sources.
-
-    issrcs - if True, then cat is already a list of sources.
-
-    """
-    import tractor, legacypipe, astrometry
-    from legacypipe.catalog import read_fits_catalog
+def _model_tim(wcs, band="r", pixelized_psf=None, psf_sigma=1.0):
+    """Blank tractor.Image onto which to render models (see srcs2image)."""
+    import tractor, legacypipe
 
     if type(wcs) is tractor.wcs.ConstantFitsWcs or type(wcs) is legacypipe.survey.LegacySurveyWcs:
         shape = wcs.wcs.shape
     else:
         shape = wcs.shape
-    model = np.zeros(shape)
-    invvar = np.ones(shape)
+    # placeholders only: the models are rendered into new arrays of type
+    # tractor.Tractor.modtype (float32), so do not allocate them in float64
+    model = np.zeros(shape, np.float32)
+    invvar = np.ones(shape, np.float32)
 
     if pixelized_psf is None:
         vv = psf_sigma**2
@@ -78,11 +75,31 @@ def srcs2image(cat, wcs, band="r", allbands="grz", pixelized_psf=None, psf_sigma
         name="model-{}".format(band),
     )
 
-    # Do we have a tractor catalog or a list of sources?
+    return tim
+
+
+def _read_srcs(cat, band="r"):
+    """Do we have a tractor catalog or a list of sources?"""
+    import astrometry
+    from legacypipe.catalog import read_fits_catalog
+
     if type(cat) is astrometry.util.fits.tabledata:
-        srcs = legacypipe.catalog.read_fits_catalog(cat, bands=[band.lower()])
+        srcs = read_fits_catalog(cat, bands=[band.lower()])
     else:
         srcs = cat
+    return srcs
+
+
+def srcs2image(cat, wcs, band="r", allbands="grz", pixelized_psf=None, psf_sigma=1.0):
+    """Build a model image from a Tractor catalog or a list of sources.
+
+    issrcs - if True, then cat is already a list of sources.
+
+    """
+    import tractor
+
+    tim = _model_tim(wcs, band=band, pixelized_psf=pixelized_psf, psf_sigma=psf_sigma)
+    srcs = _read_srcs(cat, band=band)
 
     tr = tractor.Tractor([tim], srcs)
     mod = tr.getModelImage(0)
@@ -90,6 +107,65 @@ def srcs2image(cat, wcs, band="r", allbands="grz", pixelized_psf=None, psf_sigma
     return mod
 
 
+def srcs2stamps(cat, wcs, band="r", pixelized_psf=None, psf_sigma=1.0):
+    """Render the model of every source in a Tractor catalog (or list of
+    sources) separately. Returns a list of tractor.Patch objects (None for
+    sources which do not touch the image) and the full model image (i.e.,
+    the sum of all the stamps, as in srcs2image).
+
+    """
+    import tractor
+
+    tim = _model_tim(wcs, band=band, pixelized_psf=pixelized_psf, psf_sigma=psf_sigma)
+    srcs = _read_srcs(cat, band=band)
+
+    tr = tractor.Tractor([tim], srcs)
+    stamps = [tr.getModelPatch(tim, src, minsb=tim.modelMinval) for src in srcs]
+
+    model = np.zeros(tim.shape, tr.modtype)
+    for stamp in stamps:
+        if stamp is not None:
+            stamp.addTo(model)
+
+    return stamps, model
+
+
+def cached_srcs2image(cache, cat, indx, wcs, band="r", pixelized_psf=None, exclude=False):
+    """Model image of the subset indx of the sources in the Tractor catalog cat,
+    or of all the sources *except* indx if exclude=True.
+
+    Models are linear in the sources, so rather than rendering the sources
+    again for every subset (e.g., once per central galaxy and bandpass) the
+    per-source stamps and the full model are rendered once per bandpass (see
+    srcs2stamps) and stored in cache (a dictionary, which should not outlive
+    cat), and the subset image is assembled from them.
+
+    """
+    key = (band.lower(), id(wcs), id(pixelized_psf))
+    if key not in cache:
+        cache[key] = srcs2stamps(cat, wcs, band=band, pixelized_psf=pixelized_psf)
+    stamps, model = cache[key]
+
+    indx = np.atleast_1d(indx).astype(int)
+    if exclude:
+        # the sum of the (fewest) stamps of the sources to keep or to remove
+        if len(indx) > len(stamps) // 2:
+            exclude, indx = False, np.delete(np.arange(len(stamps)), indx)
+        else:
+            model = model.copy()
+
+    if not exclude:
+        model = np.zeros_like(model)
+    for ii in indx:
+        if stamps[ii] is not None:
+            if exclude:
+                stamps[ii].addTo(model, scale=-1)
+            else:
+                stamps[ii].addTo(model)
+
+    return model
+
+
 def ellipse_mask(xcen, ycen, semia, semib, phi, x, y):
     """Simple elliptical mask."""
     xp = (x - xcen) * np.cos(phi) + (y - ycen) * np.sin(phi)
@@ -97,6 +173,80 @@ def ellipse_mask(xcen, ycen, semia, semib, phi, x, y):
     return (xp / semia) ** 2 + (yp / semib) ** 2 <= 1
 
 
+def ellipse_mask_inplace(mask, xcen, ycen, semia, semib, phi, value=True):
+    """In-place version of ellipse_mask which only evaluates the pixels within
+    the bounding box of each ellipse.
+
+    mask - boolean image, indexed as mask[x, y] (i.e., as ellipse_mask with
+      x, y = np.ogrid[0:mask.shape[0], 0:mask.shape[1]]); the pixels within
+      the ellipse(s) are set to value
+    xcen, ycen, semia, semib, phi - scalars or arrays (for a batch of ellipses)
+
+    Returns mask.
+
+    """
+    nx, ny = mask.shape
+    for xc, yc, aa, bb, pp in zip(*np.broadcast_arrays(*map(np.atleast_1d, (xcen, ycen, semia, semib, phi)))):
+        if not np.all(np.isfinite((xc, yc, aa, bb, pp))):
+            continue
+        dx = np.sqrt((aa * np.cos(pp)) ** 2 + (bb * np.sin(pp)) ** 2)
+        dy = np.sqrt((aa * np.sin(pp)) ** 2 + (bb * np.cos(pp)) ** 2)
+        x0, x1 = max(int(np.floor(xc - dx)), 0), min(int(np.ceil(xc + dx)) + 1, nx)
+        y0, y1 = max(int(np.floor(yc - dy)), 0), min(int(np.ceil(yc + dy)) + 1, ny)
+        if x1 <= x0 or y1 <= y0:
+            continue
+        x, y = np.ogrid[x0:x1, y0:y1]
+        mask[x0:x1, y0:y1][ellipse_mask(xc, yc, aa, bb, pp, x, y)] = value
+
+    return mask
+
+
+def resample_mask(mask, shape, cache=None, key=None, smooth=False):
+    """Resample a boolean mask to a new shape (e.g., from the optical to the
+    GALEX or unWISE pixel scale).
+
+    By default the result is identical to
+      resize(mask, shape, mode="edge", anti_aliasing=False) > 0
+    but if the two shapes differ by an integer factor along both axes, this
+    nearest-neighbor resampling reduces to decimating (or replicating) the
+    pixels, which is done directly. With smooth=True the result is instead
+    identical to
+      resize(mask * 1.0, shape, mode="reflect") > 0
+
+    cache - optional dictionary (e.g., one per galaxy) in which the (read-only)
+      result is stored under (key, mask.shape, shape, smooth), so that a mask
+      needed at the same pixel scale in several bandpasses is resampled once
+    key - name of the mask in the cache; it must change if the mask changes
+
+    """
+    from skimage.transform import resize
+
+    shape = tuple(shape)
+    if cache is not None:
+        cachekey = (key, mask.shape, shape, smooth)
+        if cachekey in cache:
+            return cache[cachekey]
+
+    if mask.shape == shape:
+        out = np.array(mask, bool)
+    elif smooth:
+        out = resize(mask * 1.0, shape, mode="reflect") > 0
+    elif all(nin % nout == 0 for nin, nout in zip(mask.shape, shape)):
+        fx, fy = mask.shape[0] // shape[0], mask.shape[1] // shape[1]
+        out = np.array(mask[fx // 2 :: fx, fy // 2 :: fy], bool)
+    elif all(nout % nin == 0 for nin, nout in zip(mask.shape, shape)):
+        fx, fy = shape[0] // mask.shape[0], shape[1] // mask.shape[1]
+        out = np.repeat(np.repeat(np.asarray(mask, bool), fx, axis=0), fy, axis=1)
+    else:
+        out = resize(mask, shape, mode="edge", anti_aliasing=False) > 0
+
+    if cache is not None:
+        out.flags.writeable = False
+        cache[cachekey] = out
+
+    return out
+
+
 def simple_wcs(onegal, radius=None, factor=1.0, pixscale=0.262, zcolumn="Z"):
     """Build a simple WCS object for a single galaxy.
 
@@ -5,12 +5,15 @@ legacyhalos.mpi
 Code to deal with the MPI portion of the pipeline.
 
 """
-import os, time, subprocess, pdb
+import os, time, pdb
 import numpy as np
+from pathlib import Path
 from contextlib import redirect_stdout, redirect_stderr
 
 import legacyhalos.io
 import legacyhalos.html
+import legacyhalos.profiler
+import legacyhalos.status
 
 
 def _start(galaxy, log=None, seed=None):
@@ -36,12 +39,16 @@ def _done(galaxy, galaxydir, err, t0, stage, filesuffix=None, log=None):
             flush=True,
             file=log,
         )
+        status = "fail"
         donefile = os.path.join(galaxydir, "{}{}-{}.isfail".format(galaxy, suffix, stage))
     else:
+        status = "done"
         donefile = os.path.join(galaxydir, "{}{}-{}.isdone".format(galaxy, suffix, stage))
 
-    cmd = "touch {}".format(donefile)
-    subprocess.call(cmd.split())
+    Path(donefile).touch()
+
+    # also record the status in the (optional) status database
+    legacyhalos.status.record_status(galaxy, "{}-{}".format(suffix, stage).lstrip("-"), status, runtime=time.time() - t0)
 
     print(
         "Finished galaxy {} in {:.3f} minutes.".format(galaxy, (time.time() - t0) / 60),
@@ -51,6 +58,69 @@ def _done(galaxy, galaxydir, err, t0, stage, filesuffix=None, log=None):
     return
 
 
+def work_queue(todo, comm=None, weight=None):
+    """Hand out the elements of todo to the MPI ranks on demand.
+
+    Rather than splitting the work into a fixed slice per rank up front, each
+    rank claims the next element by atomically incrementing a counter which
+    lives on rank 0 (an MPI one-sided fetch-and-add, so no rank has to act as
+    a dedicated master), and ranks which draw quick galaxies simply process
+    more of them. The elements are handed out in order of decreasing weight
+    (e.g., the diameter), so the most expensive galaxies start first and the
+    tail of the job is made up of cheap ones.
+
+    todo - list or array of work items (e.g., indices into the sample), which
+      must be the same (and in the same order) on every rank
+    comm - MPI communicator; if None, yield every element on this process
+    weight - optional cost estimate of each element of todo
+
+    This is a generator which must be called (and exhausted) by every rank of
+    comm, because creating and freeing the MPI window are collective
+    operations. A rank which stops early (e.g., because of an exception in the
+    body of the loop) cannot free the window without hanging the other ranks,
+    so it aborts the whole job instead.
+
+    """
+    ntodo = len(todo)
+    if weight is None:
+        order = np.arange(ntodo)
+    else:
+        order = np.argsort(-np.asarray(weight, dtype=float), kind="stable")
+
+    if comm is None or comm.size == 1:
+        for indx in order:
+            yield todo[indx]
+        return
+
+    from mpi4py import MPI
+
+    counter = np.zeros(1, dtype=np.int64)
+    win = MPI.Win.Allocate(counter.itemsize if comm.rank == 0 else 0, counter.itemsize, comm=comm)
+    if comm.rank == 0:
+        win.Lock(0)
+        win.Put(counter, 0)
+        win.Unlock(0)
+    comm.Barrier()
+
+    one, nextindx = np.ones(1, dtype=np.int64), np.zeros(1, dtype=np.int64)
+    exhausted = False
+    try:
+        while True:
+            win.Lock(0, MPI.LOCK_SHARED)
+            win.Fetch_and_op(one, nextindx, 0, 0, MPI.SUM)
+            win.Unlock(0)
+            if nextindx[0] >= ntodo:
+                exhausted = True
+                break
+            yield todo[order[nextindx[0]]]
+    finally:
+        if exhausted:
+            win.Free()
+        else:
+            print("Rank {} stopped consuming the work queue early; aborting.".format(comm.rank), flush=True)
+            comm.Abort(1)
+
+
 def call_ellipse(
     galaxy,
     galaxydir,
@@ -72,8 +142,23 @@ def call_ellipse(
     sbthresh=None,
     apertures=None,
     clobber=False,
+    sharedmem=False,
+    pool=None,
+    fastprofile=False,
+    float32=False,
 ):
-    """Wrapper script to do ellipse-fitting."""
+    """Wrapper script to do ellipse-fitting.
+
+    pool - optional persistent multiprocessing pool, e.g., created once per MPI
+      rank and reused for every galaxy.
+
+    fastprofile - extract the surface-brightness profiles with the vectorized
+      fixed-geometry sampler (see ellipse.fixed_isophote_profile).
+
+    float32 - do the aperture photometry in single precision (see
+      ellipse.apphot_multi).
+
+    """
     import legacyhalos.ellipse
 
     # Do not force zcolumn here; it's not always wanted or needed in ellipse.
@@ -102,9 +187,14 @@ def call_ellipse(
             verbose=verbose,
             debug=debug,
             clobber=clobber,
+            sharedmem=sharedmem,
+            pool=pool,
+            fastprofile=fastprofile,
+            float32=float32,
         )
         if write_donefile:
             _done(galaxy, galaxydir, err, t0, "ellipse", data["filesuffix"])
+        legacyhalos.profiler.write_profile()
         return err
     with open(logfile, "a") as log:
         with redirect_stdout(log), redirect_stderr(log):
@@ -127,10 +217,17 @@ def call_ellipse(
                 copy_mw_transmission=copy_mw_transmission,
                 verbose=verbose,
                 clobber=clobber,
+                sharedmem=sharedmem,
+                pool=pool,
+                fastprofile=fastprofile,
+                float32=float32,
             )
             if write_donefile:
                 _done(galaxy, galaxydir, err, t0, "ellipse", data["filesuffix"], log=log)
 
+    # flush the profiling records (if any) of this galaxy to the per-rank log
+    legacyhalos.profiler.write_profile()
+
     return err
 
 
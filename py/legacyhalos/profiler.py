@@ -0,0 +1,220 @@
+"""
+legacyhalos.profiler
+====================
+
+Lightweight per-stage timing and memory instrumentation of the pipeline.
+
+The profiler is off by default, in which case the hooks below cost next to
+nothing. When enabled (see enable_profiler), every instrumented stage appends
+one record (galaxy, stage, band, wall and CPU time, resident memory at the
+start and end of the stage, and some counts) which are periodically appended to a per-rank FITS log with
+write_profile. After a run, the logs of all the ranks can be stacked and
+summarized with read_profile and summarize_profile.
+
+Note that stages can be nested (e.g., read_multiband includes
+build_multiband_mask), and that the isophotes stage sums the time spent by
+all the workers of the multiprocessing pool on a given bandpass. The memory
+is the current resident set size (not the peak, which the kernel only tracks
+over the lifetime of the process), so the memory used by a stage is the
+difference between its end and start values.
+
+"""
+import os, time, resource
+import numpy as np
+from contextlib import contextmanager
+from functools import wraps
+
+PROFILE_COUNTS = ("nsma", "napertures", "ntasks")
+
+_PAGESIZE = resource.getpagesize()
+
+_PROFILER = {"outfile": None, "rank": 0, "galaxy": "", "records": []}
+
+
+def enable_profiler(outfile, rank=0):
+    """Start recording per-stage profiling information.
+
+    outfile - FITS file to which the records are appended by write_profile
+      (typically one file per MPI rank).
+    rank - MPI rank, recorded in the output log
+
+    """
+    _PROFILER["outfile"] = outfile
+    _PROFILER["rank"] = rank
+    _PROFILER["records"] = []
+
+
+def profiler_enabled():
+    return _PROFILER["outfile"] is not None
+
+
+def set_profile_galaxy(galaxy):
+    """Set the name of the galaxy attached to subsequent records."""
+    _PROFILER["galaxy"] = str(galaxy)
+
+
+def maxrss():
+    """Peak resident set size over the lifetime of the current process [MB]."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def currentrss():
+    """Current resident set size of the current process [MB]. Falls back to the
+    lifetime peak (see maxrss) where /proc/self/statm is not available.
+
+    """
+    try:
+        with open("/proc/self/statm") as F:
+            return int(F.read().split()[1]) * _PAGESIZE / 1024.0**2
+    except (OSError, ValueError, IndexError):
+        return maxrss()
+
+
+def add_profile_record(stage, wall, cpu, band="", galaxy=None, rss=None, **counts):
+    """Append a single record. Useful for work done outside of the main process
+    (e.g., the sum of the times spent by the workers of a multiprocessing pool).
+
+    rss - resident set size [MB] at the start and end of the stage; defaults to
+      the current value for both.
+
+    """
+    if not profiler_enabled():
+        return
+    if galaxy is None:
+        galaxy = _PROFILER["galaxy"]
+    if rss is None:
+        rss = (currentrss(),) * 2
+    rec = {
+        "galaxy": str(galaxy),
+        "stage": stage,
+        "band": band,
+        "wall": wall,
+        "cpu": cpu,
+        "rss_start": rss[0],
+        "rss_end": rss[1],
+    }
+    for key in PROFILE_COUNTS:
+        rec[key] = counts.get(key, -1)
+    _PROFILER["records"].append(rec)
+
+
+@contextmanager
+def profile_stage(stage, band="", galaxy=None, **counts):
+    """Context manager which records the wall time, CPU time, and resident memory
+    at the start and end of the enclosed code. The yielded dictionary can be used to fill in the
+    counts (see PROFILE_COUNTS) once they are known.
+
+    """
+    counts = dict(counts)
+    if not profiler_enabled():
+        yield counts
+        return
+    t0, c0, rss0 = time.time(), time.process_time(), currentrss()
+    try:
+        yield counts
+    finally:
+        wall, cpu = time.time() - t0, time.process_time() - c0
+        add_profile_record(stage, wall, cpu, band=band, galaxy=galaxy, rss=(rss0, currentrss()), **counts)
+
+
+def profiled(stage, galaxyarg=False):
+    """Decorator version of profile_stage.
+
+    galaxyarg - the first argument of the decorated function is the name of the
+      galaxy, which is attached to this and all subsequent records.
+
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if galaxyarg and len(args) > 0:
+                set_profile_galaxy(args[0])
+            with profile_stage(stage):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def write_profile(outfile=None):
+    """Append (and then clear) the accumulated records to the FITS log."""
+    import fitsio
+
+    if outfile is None:
+        outfile = _PROFILER["outfile"]
+    records = _PROFILER["records"]
+    if outfile is None or len(records) == 0:
+        return
+
+    out = np.zeros(
+        len(records),
+        dtype=[
+            ("GALAXY", "S40"),
+            ("STAGE", "S24"),
+            ("BAND", "S8"),
+            ("RANK", "i4"),
+            ("PID", "i4"),
+            ("WALL", "f4"),
+            ("CPU", "f4"),
+            ("RSS_START", "f4"),
+            ("RSS_END", "f4"),
+        ]
+        + [(key.upper(), "i4") for key in PROFILE_COUNTS],
+    )
+    for ii, rec in enumerate(records):
+        out[ii] = (
+            rec["galaxy"],
+            rec["stage"],
+            rec["band"],
+            _PROFILER["rank"],
+            os.getpid(),
+            rec["wall"],
+            rec["cpu"],
+            rec["rss_start"],
+            rec["rss_end"],
+        ) + tuple(rec[key] for key in PROFILE_COUNTS)
+
+    if os.path.isfile(outfile):
+        with fitsio.FITS(outfile, "rw") as F:
+            F["PROFILE"].append(out)
+    else:
+        outdir = os.path.dirname(outfile)
+        if outdir != "" and not os.path.isdir(outdir):
+            os.makedirs(outdir, exist_ok=True)
+        fitsio.write(outfile, out, extname="PROFILE")
+    _PROFILER["records"] = []
+
+
+def read_profile(profilefiles):
+    """Stack the (per-rank) profiling logs into a single table."""
+    import fitsio
+    from astropy.table import Table, vstack
+
+    out = []
+    for profilefile in np.atleast_1d(profilefiles):
+        tab = Table(fitsio.read(profilefile, "PROFILE"))
+        for col in ("GALAXY", "STAGE", "BAND"):
+            tab[col] = np.char.strip(np.asarray(tab[col]).astype(str))
+        out.append(tab)
+    return vstack(out)
+
+
+def summarize_profile(profile):
+    """Total wall and CPU time [hours], maximum resident memory [MB], and maximum
+    memory growth [MB] of each stage (and band), from the output of
+    read_profile.
+
+    """
+    from astropy.table import Table
+
+    groups = Table(profile).group_by(["STAGE", "BAND"])
+    out = groups.groups.keys.copy()
+    out["N"] = np.diff(groups.groups.indices).astype("i4")
+    out["WALL"] = [np.sum(grp["WALL"]) / 3600 for grp in groups.groups]
+    out["CPU"] = [np.sum(grp["CPU"]) / 3600 for grp in groups.groups]
+    out["MAXRSS"] = [np.max(np.maximum(grp["RSS_START"], grp["RSS_END"])) for grp in groups.groups]
+    out["DRSS"] = [np.max(grp["RSS_END"] - grp["RSS_START"]) for grp in groups.groups]
+    out.sort("WALL", reverse=True)
+    return out
@@ -0,0 +1,151 @@
+"""
+legacyhalos.status
+==================
+
+Append-only database of the status of each stage of the pipeline.
+
+Instead of (only) touching one galaxy-stage.isdone or .isfail file per galaxy
+and stage, which then have to be stat'ed one by one to figure out what is left
+to do, each process appends one line per finished galaxy, stage, and status
+(plus a timestamp, the runtime, and the host) to its own log in a common status
+directory. Because every process owns its log, no locking is needed, even on a
+parallel file system where SQLite or file locks are unreliable. At startup, the
+logs of all the (previous and concurrent) processes are read and merged, the
+latest record of each galaxy and stage wins, and the galaxies which are done
+are looked up in memory (see lookup_status); failures are still checked on
+disk, so they can be rerun by deleting their .isfail files.
+
+The stage of a record is the part of the name of the corresponding .isdone
+file after the galaxy name, e.g., largegalaxy-ellipse for
+NGC0001-largegalaxy-ellipse.isdone.
+
+"""
+import os, time, socket
+import numpy as np
+
+_STATUS = {"statusdir": None}
+
+
+def enable_status(statusdir):
+    """Record (and look up) the status of each stage in this directory."""
+    if not os.path.isdir(statusdir):
+        os.makedirs(statusdir, exist_ok=True)
+    _STATUS["statusdir"] = statusdir
+
+
+def status_enabled():
+    return _STATUS["statusdir"] is not None
+
+
+def status_stage(filesuffix):
+    """Stage name given the suffix of an .isdone file, e.g.,
+    -largegalaxy-ellipse.isdone --> largegalaxy-ellipse. Returns None if the
+    suffix is not an .isdone file.
+
+    """
+    if filesuffix is None or not filesuffix.endswith(".isdone"):
+        return None
+    return filesuffix[: -len(".isdone")].lstrip("-")
+
+
+def _status_logfile(statusdir):
+    return os.path.join(statusdir, "status-{}-{}.log".format(socket.gethostname(), os.getpid()))
+
+
+def record_status(galaxy, stage, status, runtime=0.0, statusdir=None):
+    """Append the status of one or more galaxies to the log of this process.
+
+    galaxy - galaxy name(s)
+    stage - stage of the pipeline (see status_stage)
+    status - done or fail
+    runtime - time spent on each galaxy [seconds]
+
+    """
+    if statusdir is None:
+        statusdir = _STATUS["statusdir"]
+    if statusdir is None:
+        return
+    if status not in ("done", "fail"):
+        raise ValueError("Unrecognized status {}".format(status))
+
+    galaxy = np.atleast_1d(galaxy)
+    runtime = np.broadcast_to(runtime, len(galaxy))
+    host, now = socket.gethostname(), time.time()
+    with open(_status_logfile(statusdir), "a") as log:
+        for gal, tt in zip(galaxy, runtime):
+            log.write("{}\t{}\t{}\t{:.3f}\t{:.3f}\t{}\n".format(gal, stage, status, now, tt, host))
+        log.flush()
+        os.fsync(log.fileno())
+
+
+def read_status(statusdir=None):
+    """Merge the logs of all the processes into a single table, sorted by time."""
+    from glob import glob
+    from astropy.table import Table
+
+    if statusdir is None:
+        statusdir = _STATUS["statusdir"]
+
+    rows = []
+    for logfile in sorted(glob(os.path.join(statusdir, "status-*.log"))):
+        with open(logfile, "r") as log:
+            for line in log:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) == 6:  # skip lines cut short by a crash
+                    rows.append(fields)
+
+    out = Table()
+    if len(rows) > 0:
+        galaxy, stage, status, timestamp, runtime, host = zip(*rows)
+    else:
+        galaxy, stage, status, timestamp, runtime, host = [], [], [], [], [], []
+    out["GALAXY"] = np.array(galaxy, dtype=str)
+    out["STAGE"] = np.array(stage, dtype=str)
+    out["STATUS"] = np.array(status, dtype=str)
+    out["TIMESTAMP"] = np.array(timestamp, dtype="f8")
+    out["RUNTIME"] = np.array(runtime, dtype="f4")
+    out["HOST"] = np.array(host, dtype=str)
+    out = out[np.argsort(out["TIMESTAMP"], kind="stable")]
+    return out
+
+
+def latest_status(statusdir=None):
+    """Dictionary of the latest status of each galaxy, keyed by stage."""
+    records = read_status(statusdir)
+    latest = {}
+    for gal, stage, status in zip(records["GALAXY"], records["STAGE"], records["STATUS"]):
+        latest.setdefault(stage, {})[gal] = status
+    return latest
+
+
+def lookup_status(galaxy, filesuffix, dependson=None, clobber=False, statusdir=None):
+    """Galaxies which are done according to the status database, following the
+    same logic as io.missing_files_one.
+
+    galaxy - galaxy names
+    filesuffix - suffix of the .isdone file of this stage
+    dependson - optional suffix of the .isdone file of the stage this stage
+      depends on
+
+    Only "done" records are trusted; every other galaxy is returned as an
+    empty string and has to be checked on disk. In particular, failures are
+    always checked on disk, so deleting the .isfail file of a galaxy is enough
+    to rerun it, and with clobber=True all the galaxies are checked on disk,
+    so that missing_files_one removes their stale .isfail files. A galaxy which
+    is done is rerun only with clobber=True, as are all the galaxies of stages
+    which do not write .isdone files.
+
+    """
+    galaxy = np.atleast_1d(galaxy).astype(str)
+    out = np.zeros(len(galaxy), "U4")
+
+    stage, depstage = status_stage(filesuffix), status_stage(dependson)
+    if clobber or stage is None or (dependson is not None and depstage is None):
+        return out
+
+    latest = latest_status(statusdir)
+    thisstage, thisdepstage = latest.get(stage, {}), latest.get(depstage, {})
+    for igal, gal in enumerate(galaxy):
+        if thisstage.get(gal) == "done" and (depstage is None or thisdepstage.get(gal) == "done"):
+            out[igal] = "done"
+    return out
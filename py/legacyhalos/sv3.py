@@ -10,6 +10,7 @@ import astropy
 import fitsio
 
 import legacyhalos.io
+from legacyhalos.profiler import profiled
 
 ZCOLUMN = "Z"
 RACOLUMN = "RA"
@@ -257,6 +258,27 @@ def mpi_args():
     )
     parser.add_argument("--verbose", action="store_true", help="Enable verbose output.")
     parser.add_argument("--clobber", action="store_true", help="Overwrite existing files.")
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        help="Write per-stage timing and memory profiling logs (one per rank) to this directory.",
+    )
+    parser.add_argument(
+        "--sharedmem",
+        action="store_true",
+        help="Pass the images to the isophote-fitting pool via shared memory.",
+    )
+    parser.add_argument(
+        "--fastprofile",
+        action="store_true",
+        help="Extract the surface-brightness profiles with the vectorized fixed-geometry sampler.",
+    )
+    parser.add_argument(
+        "--float32",
+        action="store_true",
+        help="Do the elliptical aperture photometry in single precision.",
+    )
 
     parser.add_argument(
         "--build-refcat",
@@ -362,6 +384,7 @@ def read_sample(first=None, last=None, galaxylist=None, verbose=False, filenm=""
 
 # Make choices see manga.py
 # Called by read_multiband
+@profiled("build_multiband_mask")
 def _build_multiband_mask(
     data,
     tractor,
@@ -382,13 +405,18 @@ def _build_multiband_mask(
     import numpy.ma as ma
     from copy import copy
     from legacyhalos.mge import find_galaxy
-    from legacyhalos.misc import srcs2image, ellipse_mask
+    from legacyhalos.misc import cached_srcs2image, ellipse_mask_inplace
 
     import matplotlib.pyplot as plt
     from astropy.visualization import simple_norm
 
     bands, refband = data["bands"], data["refband"]
-    xobj, yobj = np.ogrid[0 : data["refband_height"], 0 : data["refband_width"]]
+
+    # Per-source model stamps, rendered once per bandpass and reused for every
+    # central (see misc.cached_srcs2image).
+    modelcache = {}
+
+    refshape = (data["refband_height"], data["refband_width"])
 
     # If the row-index of the central galaxy is not provided, use the source
     # nearest to the center of the field.
@@ -428,14 +456,13 @@ def _build_multiband_mask(
         mgegalaxy.theta = (270 - pa) % 180
         mgegalaxy.majoraxis = majoraxis
 
-        objmask = ellipse_mask(
+        objmask = ellipse_mask_inplace(
+            np.zeros(refshape, bool),
             mgegalaxy.xmed,
             mgegalaxy.ymed,  # object pixels are True
             mgegalaxy.majoraxis,
             mgegalaxy.majoraxis * (1 - mgegalaxy.eps),
             np.radians(mgegalaxy.theta - 90),
-            xobj,
-            yobj,
         )
 
         return mgegalaxy, objmask
@@ -453,13 +480,17 @@ def _build_multiband_mask(
         mge, centralmask = tractor2mge(central, factor=neighborfactor)
         iclose = np.where([centralmask[np.int32(by), np.int32(bx)] for by, bx in zip(tractor.by, tractor.bx)])[0]
 
+        nocentral = np.delete(np.arange(len(tractor)), iclose)
         srcs = tractor.copy()
-        srcs.cut(np.delete(np.arange(len(tractor)), iclose))
-        model = srcs2image(
-            srcs,
+        srcs.cut(nocentral)
+        model = cached_srcs2image(
+            modelcache,
+            tractor,
+            iclose,
             data["{}_wcs".format(refband.lower())],
             band=refband.lower(),
             pixelized_psf=data["{}_psf".format(refband.lower())],
+            exclude=True,
         )
 
         img = data[refband].data - model
@@ -530,10 +561,10 @@ def _build_multiband_mask(
             if len(satindx) == 0:
                 print("Warning! All satellites have been dropped from band {}!".format(filt))
             else:
-                satsrcs = srcs.copy()
-                satsrcs.cut(satindx)
-                satimg = srcs2image(
-                    satsrcs,
+                satimg = cached_srcs2image(
+                    modelcache,
+                    tractor,
+                    nocentral[satindx],
                     data["{}_wcs".format(filt)],
                     band=filt.lower(),
                     pixelized_psf=data["{}_psf".format(filt)],
@@ -568,8 +599,10 @@ def _build_multiband_mask(
                 psfsrcs = None
 
             if psfsrcs:
-                psfimg = srcs2image(
-                    psfsrcs,
+                psfimg = cached_srcs2image(
+                    modelcache,
+                    tractor,
+                    psfindx,
                     data["{}_wcs".format(filt.lower())],
                     band=filt.lower(),
                     pixelized_psf=data["{}_psf".format(filt.lower())],
@@ -597,6 +630,7 @@ def _build_multiband_mask(
 
 
 # Builds threshold mask
+@profiled("read_multiband", galaxyarg=True)
 def read_multiband(
     galaxy,
     galaxydir,
@@ -619,7 +653,7 @@ def read_multiband(
     from astropy.table import Table
     from astrometry.util.fits import fits_table
     from legacypipe.bits import MASKBITS
-    from legacyhalos.io import _get_psfsize_and_depth, _read_image_data
+    from legacyhalos.io import _get_psfsize_and_depth, _read_image_data, get_residual_mask_filename
 
     # Dictionary mapping between optical filter and filename coded up in
     # coadds.py, galex.py, and unwise.py, which depends on the project.
@@ -758,6 +792,7 @@ def read_multiband(
         starmask=starmask,
         filt2pixscale=filt2pixscale,
         fill_value=fill_value,
+        residmaskfile=get_residual_mask_filename(galaxy, galaxydir, filesuffix),
         verbose=verbose,
     )
 
@@ -818,6 +853,10 @@ def call_ellipse(
     clobber=False,
     debug=False,
     logfile=None,
+    pool=None,
+    sharedmem=False,
+    fastprofile=False,
+    float32=False,
 ):
     """Wrapper on legacyhalos.mpi.call_ellipse but with specific preparatory work
     and hooks for the legacyhalos project.
@@ -894,6 +933,10 @@ def call_ellipse(
                     input_ellipse=input_ellipse,
                     verbose=verbose,
                     debug=True,
+                    pool=pool,
+                    sharedmem=sharedmem,
+                    fastprofile=fastprofile,
+                    float32=float32,
                 )  # , logfile=logfile)# no logfile and debug=True, otherwise this will crash
 
                 # no need to redo the nominal ellipse-fitting
@@ -979,6 +1022,10 @@ def call_ellipse(
             clobber=clobber,
             debug=debug,
             logfile=logfile,
+            pool=pool,
+            sharedmem=sharedmem,
+            fastprofile=fastprofile,
+            float32=float32,
         )
 
     return
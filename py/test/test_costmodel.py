@@ -0,0 +1,37 @@
+import os
+import numpy as np
+import legacyhalos.costmodel as costmodel
+
+
+def test_fit_and_predict(tmp_path):
+    rand = np.random.RandomState(1)
+    width = rand.uniform(100, 5000, 200)
+    nsource = rand.randint(0, 2000, 200)
+    features = costmodel.cost_features(width, 3, nsource=nsource)
+    minutes = 10 ** (-4.0 + 1.5 * features[:, 0] + 0.3 * features[:, 2])
+    minutes[:10] = np.nan  # never finished
+
+    model = costmodel.fit_cost_model(features, minutes)
+    assert model["nfit"] == 190
+    assert model["rms"] < 1e-8
+    assert np.allclose(costmodel.predict_cost(model, features[10:]), minutes[10:])
+
+    # NBAND is constant and MULT is missing, so neither is fit
+    assert np.allclose(model["coeff"], [-4.0, 1.5, 0.0, 0.3, 0.0])
+
+    outfile = os.path.join(str(tmp_path), "costmodel.fits")
+    costmodel.write_cost_model(outfile, model)
+    model2 = costmodel.read_cost_model(outfile)
+    assert np.allclose(costmodel.predict_cost(model2, features), costmodel.predict_cost(model, features))
+
+
+def test_read_log_timings(tmp_path):
+    with open(os.path.join(str(tmp_path), "NGC0001-ellipse.log"), "w") as log:
+        log.write("Finished galaxy NGC0001 in 1.000 minutes.\nFinished galaxy NGC0001 in 2.500 minutes.\n")
+    minutes = costmodel.read_log_timings(["NGC0001", "NGC0002"], [str(tmp_path)] * 2)
+    assert minutes[0] == 2.5 and np.isnan(minutes[1])
+
+
+def test_simulate_work_queue():
+    load = costmodel.simulate_work_queue([5, 4, 3, 3, 3], 2)
+    assert np.array_equal(np.sort(load), [8, 10])
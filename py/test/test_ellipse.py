@@ -0,0 +1,143 @@
+import warnings
+import numpy as np
+import numpy.ma as ma
+import legacyhalos.ellipse as ellipse
+
+
+def _mock_galaxy(nn=301, seed=1, nsersic=2.0):
+    rand = np.random.RandomState(seed)
+    yy, xx = np.mgrid[0:nn, 0:nn]
+    x0, y0, theta, eps = 150.3, 149.7, np.radians(30.0), 0.4
+    xp = (xx - x0) * np.cos(theta) + (yy - y0) * np.sin(theta)
+    yp = -(xx - x0) * np.sin(theta) + (yy - y0) * np.cos(theta)
+    rr = np.hypot(xp, yp / (1 - eps))
+    var = np.full((nn, nn), 0.01**2, "f4")
+    img = (100.0 * np.exp(-((rr / 15.0) ** (1 / nsersic))) + rand.normal(0, 0.01, (nn, nn))).astype("f4")
+    mask = rand.uniform(size=(nn, nn)) < 0.05
+    return img, mask, var, x0, y0, theta, eps
+
+
+def test_apphot_multi_float32():
+    img, mask, var, x0, y0, theta, eps = _mock_galaxy()
+    sma = np.linspace(1.0, 140.0, 50)
+    smb = sma * (1 - eps)
+
+    out64 = ellipse.apphot_multi(img, mask, theta, x0, y0, sma, smb, 0.262, var=var)
+    out32 = ellipse.apphot_multi(img, mask, theta, x0, y0, sma, smb, 0.262, var=var, dtype="f4")
+
+    flux64, fracmasked64, area64, ferr64 = out64
+    flux32, fracmasked32, area32, ferr32 = out32
+    assert np.all(np.abs(flux32 / flux64 - 1) < 1e-5)
+    assert np.all(np.abs(ferr32 / ferr64 - 1) < 1e-5)
+    assert np.allclose(fracmasked32, fracmasked64, rtol=0, atol=1e-6)
+    assert np.array_equal(area32, area64)
+
+
+def test_apphot_multi_nonfinite():
+    img, mask, var, x0, y0, theta, eps = _mock_galaxy()
+    sma = np.linspace(1.0, 140.0, 50)
+    smb = sma * (1 - eps)
+
+    bad = np.zeros_like(mask)
+    bad[140:160, 145:150], bad[100, 100] = True, True
+    nanimg, nanvar = img.copy(), var.copy()
+    nanimg[140:160, 145:150] = np.nan
+    nanvar[100, 100] = np.inf
+
+    out = ellipse.apphot_multi(nanimg, mask, theta, x0, y0, sma, smb, 0.262, var=nanvar)
+    ref = ellipse.apphot_multi(img, mask | bad, theta, x0, y0, sma, smb, 0.262, var=var)
+    for oo, rr in zip(out, ref):
+        assert np.all(np.isfinite(oo))
+        assert np.array_equal(oo, rr)
+
+
+def test_elliptical_coords_map():
+    shape, x0, y0, theta, eps = (120, 90), 40.3, 61.8, np.radians(30.0), 0.4
+    box = (10, 70, 35, 100)
+    ellipse.clear_geometry_cache()
+    rell, phi = ellipse.elliptical_coords_map(shape, x0, y0, theta, eps)
+    cutrell, cutphi = ellipse.elliptical_coords_map(shape, x0, y0, theta, eps, box=box)
+    assert cutrell.shape == (65, 60)
+    assert np.array_equal(cutrell, rell[35:100, 10:70])
+    assert np.array_equal(cutphi, phi[35:100, 10:70])
+    assert ellipse.elliptical_coords_map(shape, x0, y0, theta, eps, box=box)[0] is cutrell
+    ellipse.clear_geometry_cache()
+
+
+def test_cog_dofit_batch():
+    # a Sersic n=4 curve of growth pins mtot on its lower bound; n=1 does not
+    for nsersic in (1.0, 4.0):
+        img, mask, var, x0, y0, theta, eps = _mock_galaxy(nsersic=nsersic, seed=5)
+        sma = np.linspace(1.0, 140.0, 60)
+        flux, _, _, ferr = ellipse.apphot_multi(img, mask, theta, x0, y0, sma, sma * (1 - eps), 0.262, var=var * 100**2)
+        sma_arcsec = sma * 0.262
+        cogmag = 22.5 - 2.5 * np.log10(flux)
+        cogmagerr = 2.5 * ferr / flux / np.log(10)
+        bounds = ([cogmag[-1] - 2.0, 0, 0, 0], np.inf)
+
+        popt, _ = ellipse.cog_dofit(sma_arcsec, cogmag, cogmagerr, bounds=bounds)
+        monte_mags = np.random.RandomState(1).normal(loc=cogmag, scale=cogmagerr, size=(20, len(cogmag)))
+        loop = [ellipse.cog_dofit(sma_arcsec, mags, cogmagerr, bounds=bounds) for mags in monte_mags]
+        loop_popt, loop_chi2 = np.array([pp for pp, _ in loop]), np.array([cc for _, cc in loop])
+        batch_popt, batch_chi2 = ellipse.cog_dofit_batch(sma_arcsec, monte_mags, cogmagerr, popt, bounds=bounds)
+
+        assert np.all(batch_chi2 <= loop_chi2 + 1e-6 * (1 + loop_chi2))
+        loop_sig, batch_sig = np.std(loop_popt, axis=0), np.std(batch_popt, axis=0)
+        for ii in range(4):
+            if loop_sig[ii] > 1e-8:
+                assert np.abs(batch_sig[ii] / loop_sig[ii] - 1) < 1e-2
+            else:  # on the bound in every realization
+                assert batch_sig[ii] < 1e-8
+        assert (nsersic == 4.0) == (loop_sig[0] < 1e-8)
+
+
+def test_fixed_isophote_profile():
+    img, mask, var, x0, y0, theta, eps = _mock_galaxy(nsersic=1.0)
+    img = ma.masked_array(img, mask)
+    sma = np.hstack((0.0, np.geomspace(1.0, 120.0, 40)))
+
+    fast = ellipse.fixed_isophote_profile(img, sma, theta, eps, x0, y0)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        isos = [ellipse.integrate_isophot_one(img, _sma, theta, eps, x0, y0, "median", 3, 3) for _sma in sma]
+    intens = np.array([iso.intens for iso in isos])
+    snr = intens / np.array([max(iso.int_err, 1e-10) for iso in isos])
+
+    # isophotes inside minsma come straight from EllipseSample
+    small = sma < 5
+    assert np.allclose(fast.intens[small], intens[small])
+    assert np.array_equal(fast.ndata[small], [iso.ndata for iso in isos[: np.sum(small)]])
+    assert np.all(np.isfinite(fast.a3)) and np.all(np.isfinite(fast.a4))
+
+    # elsewhere they agree to better than a percent at high S/N
+    good = snr > 200
+    assert np.sum(good * ~small) > 20
+    assert np.all(np.abs(fast.intens[good] / intens[good] - 1) < 1e-2)
+
+
+def _attach_generations(spec0, spec1):
+    out0 = ellipse._attach_shared_image(spec0)
+    same = ellipse._attach_shared_image(spec0) is out0
+    out0 = out0.copy()
+    out1 = ellipse._attach_shared_image(spec1).copy()
+    return out0, out1, same, list(ellipse._SHARED_IMAGES["images"])
+
+
+def test_shared_image_generations():
+    import multiprocessing
+
+    img, mask, _, _, _, _, _ = _mock_galaxy(nn=64)
+    img = ma.masked_array(img, mask)
+    shms0, spec0 = ellipse.share_image(img, generation=0)
+    shms1, spec1 = ellipse.share_image(ma.masked_array(img.data[::-1], mask), generation=1)
+    try:
+        with multiprocessing.Pool(1) as pool:
+            out0, out1, same, attached = pool.apply(_attach_generations, (spec0, spec1))
+    finally:
+        ellipse.release_shared_image(shms0 + shms1)
+
+    assert np.array_equal(out0.data, img.data) and np.array_equal(out0.mask, img.mask)
+    assert np.array_equal(out1.data, img.data[::-1])
+    assert same
+    # a new generation detaches from all the images of the previous one
+    assert attached == [spec1[1][0]]
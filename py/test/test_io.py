@@ -0,0 +1,133 @@
+import numpy as np
+import pytest
+import legacyhalos.io as io
+
+
+def _mock_ellipsefit(sbthresh, apertures, bands, nsma=20):
+    ellipsefit = {}
+    for key, _ in io._get_ellipse_datamodel(sbthresh, apertures, bands=bands):
+        if key == "bands":
+            ellipsefit[key] = np.array(bands)
+        elif key in ("refband", "integrmode"):
+            ellipsefit[key] = "r"
+        elif key in ("success", "fitgeometry", "input_ellipse", "largeshift"):
+            ellipsefit[key] = True
+        elif key.startswith(("stop_code_", "ndata_", "nflag_", "niter_")):
+            ellipsefit[key] = np.arange(nsma, dtype=np.int16)
+        elif key.startswith(("sma_", "intens_", "cog_sma_", "cog_flux_")) and key[-2] == "_":
+            ellipsefit[key] = np.linspace(0, 1, nsma).astype("f4")
+        else:
+            ellipsefit[key] = np.float32(len(key))
+    return ellipsefit
+
+
+def test_ellipsefit_roundtrip(tmp_path):
+    sbthresh, apertures, bands = [23, 24, 25], [0.5, 1.0], ["g", "r", "z"]
+    ellipsefit = _mock_ellipsefit(sbthresh, apertures, bands)
+
+    io.write_ellipsefit("galaxy", str(tmp_path), ellipsefit, sbthresh=sbthresh, apertures=apertures, bands=bands)
+    out = io.read_ellipsefit("galaxy", str(tmp_path))
+
+    assert sorted(out.keys()) == sorted(ellipsefit.keys())
+    for key in ellipsefit.keys():
+        assert np.array_equal(out[key], ellipsefit[key])
+    assert io.get_ellipse_datamodel(sbthresh, apertures, bands=bands) is io.get_ellipse_datamodel(
+        sbthresh, apertures, bands=bands
+    )
+
+    ellipsefit["notindatamodel"] = 1.0
+    with pytest.raises(ValueError):
+        io.write_ellipsefit("galaxy", str(tmp_path), ellipsefit, sbthresh=sbthresh, apertures=apertures, bands=bands)
+
+
+def test_scan_missing_files(tmp_path):
+    # galaxy directories nested in RA slices; galaxy E has no directory at all
+    files = {
+        "001/A": ["A-coadds.isdone", "A-ellipse.isdone"],
+        "001/B": ["B-coadds.isdone"],
+        "002/C": ["C-ellipse.isfail"],
+        "002/D": ["D-ellipse.isdone"],
+    }
+    for gdir, filenames in files.items():
+        (tmp_path / gdir).mkdir(parents=True)
+        for filename in filenames:
+            (tmp_path / gdir / filename).touch()
+
+    missargs = []
+    for gal, raslice in zip("ABCDE", ["001", "001", "002", "002", "003"]):
+        gdir = str(tmp_path / raslice / gal)
+        missargs.append([gdir + "/{}-ellipse.isdone".format(gal), gdir + "/{}-coadds.isdone".format(gal), False])
+
+    todo = io.scan_missing_files(missargs, nthreads=2)
+    assert list(todo) == [io.missing_files_one(*_missargs) for _missargs in missargs]
+    assert list(todo) == ["done", "todo", "fail", "todo", "todo"]
+
+
+def test_fitsimage_read(tmp_path):
+    import fitsio
+
+    image = np.random.RandomState(1).randint(-1000, 1000, size=(37, 50)).astype("i4")
+    imfile, fzfile = str(tmp_path / "image.fits"), str(tmp_path / "image.fits.fz")
+    fitsio.write(imfile, image)
+    fitsio.write(fzfile, image, compress="rice", tile_dims=[8, 8])
+
+    memmap, fz = io.FitsImage(imfile), io.FitsImage(fzfile)
+    assert memmap.shape == fz.shape == image.shape
+    for img in (memmap, fz):
+        out = img.read()
+        assert out.dtype == np.float32
+        assert np.array_equal(out, image)
+    assert memmap._memmap is not None and fz._memmap is None
+
+
+class _MockTractor(object):
+    """Minimal stand-in for an astrometry.util.fits.fits_table."""
+
+    def __init__(self, cat):
+        self._cat = cat
+
+    def __len__(self):
+        return len(self._cat)
+
+    def __getattr__(self, col):
+        return self._cat[col]
+
+    def columns(self):
+        return list(self._cat.dtype.names)
+
+    def get(self, col):
+        return self._cat[col]
+
+
+def test_gather_psfsize_and_depth(tmp_path):
+    import fitsio
+
+    rand = np.random.RandomState(1)
+    bands, pixscale = ["g", "r", "z"], 0.262
+    tractorfiles, cats = [], []
+    for igal, nobj in enumerate([2000, 1501, 0, 3]):
+        cat = np.zeros(nobj, dtype=[(col, "f4") for col in ("bx", "by", "psfsize_g", "psfdepth_g", "psfsize_r", "psfdepth_r")])
+        cat["bx"], cat["by"] = rand.uniform(0, 3600, (2, nobj))
+        for filt in ("g", "r"):
+            cat["psfsize_{}".format(filt)] = rand.uniform(0.8, 2.0, nobj) * (rand.uniform(size=nobj) > 0.1)
+            cat["psfdepth_{}".format(filt)] = rand.uniform(100, 5000, nobj) * (rand.uniform(size=nobj) > 0.1)
+        tractorfile = str(tmp_path / "galaxy{}-tractor.fits".format(igal))
+        fitsio.write(tractorfile, cat)
+        tractorfiles.append(tractorfile)
+        cats.append(cat)
+    tractorfiles.append(str(tmp_path / "missing-tractor.fits"))
+
+    for incenter in (False, True):
+        out = io.gather_psfsize_and_depth(tractorfiles, bands, pixscale, incenter=incenter, nthreads=2)
+        assert list(out["GALAXY"]) == ["galaxy0", "galaxy1", "galaxy2", "galaxy3", "missing"]
+        assert list(out["NSOURCE"]) == [2000, 1501, 0, 3, 0]
+        for igal in (0, 1):
+            ref = io._get_psfsize_and_depth(_MockTractor(cats[igal]), bands, pixscale, incenter=incenter)
+            for filt in ("g", "r"):
+                for col in ("psfsigma", "psfsize", "psfdepth"):
+                    assert out["{}_{}".format(col.upper(), filt.upper())][igal] == ref["{}_{}".format(col, filt)]
+                    assert out["{}_{}".format(col.upper(), filt.upper())][igal] > 0
+        # empty or missing catalogs, and bandpasses without measurements
+        for col in out.colnames[3:]:
+            assert out[col][2] == 0 and out[col][4] == 0
+        assert np.all(out["PSFSIZE_Z"] == 0)
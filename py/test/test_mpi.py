@@ -0,0 +1,22 @@
+import numpy as np
+from legacyhalos.mpi import work_queue
+
+
+class _SerialComm(object):
+    rank, size = 0, 1
+
+
+def test_work_queue_order():
+    todo = np.array([10, 11, 12, 13, 14])
+    weight = [1.0, 5.0, 3.0, 5.0, 0.5]
+
+    # largest first, ties in their original order
+    assert list(work_queue(todo, weight=weight)) == [11, 13, 12, 10, 14]
+    assert list(work_queue(todo, comm=_SerialComm(), weight=weight)) == [11, 13, 12, 10, 14]
+    assert list(work_queue(todo)) == list(todo)
+    assert list(work_queue(list(todo), weight=np.array(weight))) == [11, 13, 12, 10, 14]
+
+    # works on any sequence, e.g., the RA-slice chunks of --build-SGA
+    chunks = [[1, 2], [3], [4, 5, 6]]
+    assert list(work_queue(chunks, weight=[len(chunk) for chunk in chunks])) == [[4, 5, 6], [1, 2], [3]]
+    assert list(work_queue([], weight=[])) == []
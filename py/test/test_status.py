@@ -0,0 +1,78 @@
+import os
+import argparse
+import numpy as np
+from astropy.table import Table
+import legacyhalos.status as status
+
+
+def test_lookup_status(tmp_path):
+    statusdir = str(tmp_path)
+    status.record_status(["a", "b", "c", "d"], "largegalaxy-coadds", "done", statusdir=statusdir)
+    status.record_status(["a", "b"], "largegalaxy-ellipse", "done", runtime=[10.0, 20.0], statusdir=statusdir)
+    status.record_status("c", "largegalaxy-ellipse", "fail", statusdir=statusdir)
+    status.record_status("b", "largegalaxy-coadds", "fail", statusdir=statusdir)  # latest record wins
+
+    records = status.read_status(statusdir)
+    assert len(records) == 8
+
+    # only "done" is trusted; everything else is checked on disk
+    galaxy = ["a", "b", "c", "d", "e"]
+    out = status.lookup_status(galaxy, "-largegalaxy-ellipse.isdone", dependson="-largegalaxy-coadds.isdone", statusdir=statusdir)
+    assert list(out) == ["done", "", "", "", ""]
+
+    out = status.lookup_status(galaxy, "-largegalaxy-coadds.isdone", clobber=True, statusdir=statusdir)
+    assert np.all(out == "")
+
+    out = status.lookup_status(galaxy, "-largegalaxy-grz-montage.png", statusdir=statusdir)
+    assert np.all(out == "")
+
+
+def test_missing_files_isfail(tmp_path, monkeypatch):
+    import legacyhalos.SGA as SGA
+
+    monkeypatch.setenv("LEGACYHALOS_DATA_DIR", str(tmp_path / "data"))
+    monkeypatch.setenv("LEGACYHALOS_HTML_DIR", str(tmp_path / "html"))
+    monkeypatch.setitem(status._STATUS, "statusdir", None)
+    status.enable_status(str(tmp_path / "status"))
+
+    sample = Table()
+    sample["GROUP_NAME"] = ["NGC0001", "NGC0002"]
+    sample["GROUP_RA"] = [1.0, 2.0]
+    sample["GROUP_DIAMETER"] = [1.0, 2.0]
+    galaxy, galaxydir = SGA.get_galaxy_galaxydir(sample)
+    for gal, gdir in zip(galaxy, galaxydir):
+        os.makedirs(gdir)
+        open(os.path.join(gdir, "{}-largegalaxy-coadds.isdone".format(gal)), "w").close()
+    open(os.path.join(galaxydir[0], "{}-largegalaxy-ellipse.isdone".format(galaxy[0])), "w").close()
+    failfile = os.path.join(galaxydir[1], "{}-largegalaxy-ellipse.isfail".format(galaxy[1]))
+    open(failfile, "w").close()
+    status.record_status(galaxy[1], "largegalaxy-ellipse", "fail")
+
+    args = argparse.Namespace(
+        coadds=False,
+        pipeline_coadds=False,
+        ellipse=True,
+        build_SGA=False,
+        htmlplots=False,
+        htmlindex=False,
+        remake_cogqa=False,
+        clobber=False,
+        scandirs=False,
+        nproc=1,
+        verbose=False,
+    )
+    _, todo, done, fail = SGA.missing_files(args, sample)
+    assert list(done[0]) == [0] and list(fail[0]) == [1]
+
+    # deleting the .isfail file reruns the galaxy, even though the database
+    # still says it failed
+    os.remove(failfile)
+    _, todo, done, fail = SGA.missing_files(args, sample)
+    assert list(todo[0]) == [1] and list(done[0]) == [0] and len(fail[0]) == 0
+
+    # clobber removes stale .isfail files
+    open(failfile, "w").close()
+    args.clobber = True
+    _, todo, done, fail = SGA.missing_files(args, sample)
+    assert list(todo[0]) == [0, 1]
+    assert not os.path.isfile(failfile)